@@ -2,7 +2,6 @@ import os
 import logging
 import pandas as pd
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 from scipy.stats import spearmanr
 
 import sdm.utils.data_utils as dutils
@@ -10,14 +9,82 @@ import sdm.utils.data_utils as dutils
 logger = logging.getLogger(__name__)
 
 
-def sim_vecs( v1, v2):
-	try:
-		s = cosine_similarity(v1.reshape(1, -1), v2.reshape(1, -1))
-	except ValueError:
-		v1 = np.nan_to_num(v1)
-		v2 = np.nan_to_num(v2)
-		s = cosine_similarity(v1.reshape(1, -1), v2.reshape(1, -1))
-	return s[0][0]
+def batch_cosine(A, B):
+	"""
+	Cosine similarities between the rows of A and B. Rows with non-finite entries, which stand for missing vectors,
+	have similarity NaN, and rows of zeros have similarity 0
+	"""
+	A = np.asarray(A, dtype=float)
+	B = np.asarray(B, dtype=float)
+	dots = np.einsum("ij,ij->i", A, B)
+	norms = np.linalg.norm(A, axis=1) * np.linalg.norm(B, axis=1)
+	ret = np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+	ret[~(np.isfinite(A).all(axis=1) & np.isfinite(B).all(axis=1))] = np.nan
+	return ret
+
+
+def valid_pairs(scores, sim_scores):
+	"""
+	:return: gold scores and similarities of the items whose similarity is not NaN, the ones to be correlated
+	"""
+	scores = np.asarray(scores, dtype=float)
+	sim_scores = np.asarray(sim_scores, dtype=float)
+	valid = ~np.isnan(sim_scores)
+	if not valid.all():
+		logger.info("{} of {} items are left out of the correlation for missing vectors".format(
+			len(valid) - valid.sum(), len(valid)))
+	return scores[valid], sim_scores[valid]
+
+
+def load_ks_mapping(mapping_fpath):
+	"""
+	:return: ids of the KS items, sorted, and the rows of the output file holding the first and second
+			 sentence of each item
+	"""
+	mapping = pd.read_csv(mapping_fpath, delimiter="\t", header=None)
+	mapping = mapping.drop_duplicates(subset=0, keep="last").sort_values(0)
+	return mapping[0].values, mapping[1].values, mapping[2].values
+
+
+def ks_similarities(AC_vectors, rows1, rows2, AC_mask=None):
+	"""
+	:param AC_mask: boolean array marking the AC vectors that are not missing, pairs with a missing one have
+					similarity NaN
+	"""
+	AC_vectors = np.asarray(AC_vectors)
+	ret = batch_cosine(AC_vectors[rows1], AC_vectors[rows2])
+	if AC_mask is not None:
+		ret[~(AC_mask[rows1] & AC_mask[rows2])] = np.nan
+	return ret
+
+
+def dtfit_targets(data, target_relations, vecs):
+	"""
+	:return: rows of the dataset whose target word is in the vector space, and the matrix of their vectors
+	"""
+	rows, vectors = [], []
+	for i, label in zip(data.index, target_relations):
+		if label == "OBJ": label = "OBJECT"
+		if label not in data.columns:
+			continue
+		try:
+			vectors.append(vecs[(data[label][i], "N")])
+			rows.append(i)
+		except KeyError:
+			pass
+
+	return np.array(rows, dtype=int), np.array(vectors).reshape(len(rows), -1)
+
+
+def dtfit_similarities(AC_vectors, rows, target_vectors, AC_mask=None):
+	"""
+	:param AC_mask: boolean array marking the AC vectors that are not missing, items with a missing one have
+					similarity NaN
+	"""
+	ret = batch_cosine(np.asarray(AC_vectors)[rows], target_vectors)
+	if AC_mask is not None:
+		ret[~AC_mask[rows]] = np.nan
+	return ret
 
 
 class Evaluation(object):
@@ -29,28 +96,43 @@ class Evaluation(object):
 		if vector_fpath: self.vecs = dutils.load_vectors(vector_fpath, len_vectors=-1)
 		self.eval_funcs = {"ks": self.ks_evaluation, "dtfit": self.dtfit_evaluation, "tfit_mit": self.tfit_mit_evaluation}
 
+	def load_AC_vectors(self):
+		"""
+		:return: AC vectors of the output file as a matrix, where missing vectors are rows of NaN, and a boolean array
+				 marking the vectors that are not missing
+		"""
+		# matrices written with --binary-output are memory-mapped, otherwise vectors are parsed from the output file
+		binary = dutils.load_results_binary(self.res_data)
+		if binary is not None:
+			_, AC_vectors, mask = binary
+			AC_mask = np.asarray(mask[:, 1])
+		else:
+			res = pd.read_csv(self.res_data, delimiter="\t", usecols=["AC_vector"])
+			vectors = [np.array([float(x) for x in v.split()]) if isinstance(v, str) and v != "None" else None
+					   for v in res["AC_vector"]]
+			dim = next((len(v) for v in vectors if v is not None), 0)
+			AC_vectors = np.array([v if v is not None else np.full(dim, np.nan) for v in vectors])
+			AC_vectors = AC_vectors.reshape(len(vectors), dim)
+			AC_mask = np.array([v is not None for v in vectors], dtype=bool)
+
+		if not AC_mask.all():
+			logger.info("{} of {} items have no AC vector".format(len(AC_mask) - AC_mask.sum(), len(AC_mask)))
+		return AC_vectors, AC_mask
+
 	def ks_evaluation(self):
 		# load mapping id
-		mapping = pd.read_csv(self.mapping, delimiter="\t", header=None)
-		map_id = {}
-		for i in mapping.index: map_id[mapping[0][i]] = (mapping[1][i], mapping[2][i])
+		ids, rows1, rows2 = load_ks_mapping(self.mapping)
 		# load dataset and output files
 		data = pd.read_csv(self.dataset, delimiter="\t")
 
-		res = pd.read_csv(self.res_data, delimiter="\t")
-		sim_res = {}
-		for k in sorted(map_id.keys()):
-			v1 = np.array([float(x) for x in res["AC_vector"][map_id[k][0]].split()])
-			v2 = np.array([float(x) for x in res["AC_vector"][map_id[k][1]].split()])
-
-			sim = sim_vecs(v1, v2)
-			sim_res[k] = sim
+		AC_vectors, AC_mask = self.load_AC_vectors()
+		sim_scores = ks_similarities(AC_vectors, rows1, rows2, AC_mask)
 
 		#spermancorr
-		scores = [data["score"][i] for i in sorted(sim_res.keys())]
-		sim_scores = [sim_res[i] for i in sorted(sim_res.keys())]
-		logger.info("Spearman's correlation: {}".format(spearmanr(scores, sim_scores)))
-		print(spearmanr(scores, sim_scores))
+		scores = data["score"].loc[ids].values
+		correlation = spearmanr(*valid_pairs(scores, sim_scores))
+		logger.info("Spearman's correlation: {}".format(correlation))
+		print(correlation)
 
 		# write sims
 		data["sims"] = sim_scores
@@ -58,27 +140,19 @@ class Evaluation(object):
 
 	def dtfit_evaluation(self):
 		data = pd.read_csv(self.dataset, delimiter="\t")
-		res = pd.read_csv(self.res_data, delimiter="\t")
-		sim_res = {}
-		for i in data.index:
-			v_target = np.array([float(x) for x in res["AC_vector"][i].split()])
-			try:
-				label = res["target-relation"][i]
-				if label == "OBJ": label = "OBJECT"
-				v_original = self.vecs[data[label][i]]
-				sim = sim_vecs(v_target, v_original)
-				sim_res[i] = sim
-			except KeyError:
-				pass
+		# vectors are not needed from the text output
+		res = pd.read_csv(self.res_data, delimiter="\t", usecols=["target-relation"])
+		AC_vectors, AC_mask = self.load_AC_vectors()
+		rows, target_vectors = dtfit_targets(data, res["target-relation"], self.vecs)
+		sim_scores = dtfit_similarities(AC_vectors, rows, target_vectors, AC_mask)
 
 		#spermancorr
-		scores = [data["mean_rat"][i] for i in sorted(sim_res.keys())]
-		sim_scores = [sim_res[i] for i in sorted(sim_res.keys())]
-		logger.info("Spearman's correlation: {}".format(spearmanr(scores, sim_scores)[0]))
+		scores = data["mean_rat"].loc[rows].values
+		logger.info("Spearman's correlation: {}".format(spearmanr(*valid_pairs(scores, sim_scores))[0]))
 		#print(spearmanr(scores, sim_scores))
 
 		# write sims
-		data_out = data.ix[sorted(sim_res.keys())]
+		data_out = data.loc[rows].copy()
 		data_out["sims"] = sim_scores
 		out_fname = os.path.join(self.out_fold, os.path.basename(self.dataset) + ".sims")
 		data_out.to_csv(out_fname, index=False)
@@ -1,130 +1,359 @@
+import os
 import functools
 import logging
+import multiprocessing
 import uuid
 import collections
 import itertools
 import shutil
 import tempfile
 import gzip
+import glob
+import json
 
 import time
 
 from sdm.utils import os_utils as outils
 from sdm.utils import data_utils as dutils
 from sdm.utils import corpus_utils as cutils
+from sdm.utils import vocabulary_utils as vutils
 from sdm.utils import Pipeline as putils
 from sdm.utils.FileMerger import filesmerger as fmutils
 
 logger = logging.getLogger(__name__)
 
 def stats_manager(output_dir, input_paths, acceptable_labels, delimiter, batch_size_farm, batch_size_merge,
-                  w_thresh, workers):
+                  w_thresh, workers, max_batch_tokens=0, partitions=1, binary_runs=False, corpus_cache=False):
 
     tmp_folder = tempfile.mkdtemp(dir=output_dir)+"/"
     accepted_pos, accepted_rels = dutils.load_acceptable_labels_from_file(acceptable_labels)
 
-    list_of_functions = [functools.partial(cutils.CoNLLReader, delimiter),
+    cache_dir = None
+    if corpus_cache:
+        cache_dir = _corpus_cache_dir(output_dir)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir)
+
+    # sentences are streamed in batches of at most batch_size_farm sentences and max_batch_tokens tokens
+    list_of_functions = [functools.partial(cutils.CoNLLReader, delimiter, batch_size=batch_size_farm,
+                                           max_tokens=max_batch_tokens),
                          functools.partial(cutils.DependencyBuilder, accepted_pos, accepted_rels),
-                         functools.partial(extract_stats, tmp_folder)]
+                         functools.partial(extract_stats, tmp_folder, partitions=partitions,
+                                           binary_runs=binary_runs, cache_dir=cache_dir)]
 
     conll_pip = putils.Farm(list_of_functions, workers, batch_size_farm)
 
-    reduce_fn = functools.partial(fmutils.merge_and_collapse_iterable, output_filename=None, tmpdir=tmp_folder,
-                                   delete_input=True)
+    # binary runs can only be merged by merge_partitions
+    own_merge = partitions > 1 or binary_runs
 
     start_time = time.time()
 
-    merged_fname = conll_pip.map_reduce(outils.get_filenames(input_paths), reduce_fn, batch_size_merge)
+    input_fnames = list(outils.get_filenames(input_paths))
+    merged_fname = conll_pip.map_reduce(input_fnames, _reduce_fn(tmp_folder, own_merge), batch_size_merge)
 
     end_time = time.time()
     logger.info("Finished pipeline.run() and extract_patterns: time elapsed {} seconds".format(end_time-start_time))
 
     output_fname = output_dir+"/{}-freqs.gz".format("lemma")
 
-    shutil.move (merged_fname, output_fname)
+    if own_merge:
+        # UTF-8 bytes sort as the strings they encode
+        merge_partitions(merged_fname, output_fname, tmp_folder, workers, batch_size_merge,
+                         decode_key=bytes.decode if binary_runs else None)
+    else:
+        shutil.move (merged_fname, output_fname)
+
+    if corpus_cache:
+        # written last, so that an interrupted pass leaves no usable cache
+        cutils.write_cache_manifest(cache_dir, input_fnames, accepted_pos, accepted_rels, delimiter)
 
     shutil.rmtree(tmp_folder)
 
     return output_fname
 
 
-def extract_stats(tmp_folder, list_of_sentences):
+def _lemma_pos_bytes(lemma_pos):
+    return " ".join(lemma_pos).encode("utf-8")
+
+
+def _corpus_cache_dir(output_dir):
+    return output_dir + "/corpus-cache/"
+
+
+def extract_stats(tmp_folder, list_of_sentences, partitions=1, binary_runs=False, cache_dir=None):
     """
 
     :param str tmp_folder: path to temporary folder
-    :param list_of_sentences: a tuple containing two objects: a words dictionary {token_id : {"lemma":lemma,"upos":pos}} and a dependencies dictionary {head_id:[(dep_id, role)]}
+    :param list_of_sentences: a tuple containing two objects: a words dictionary {token_id : Word} and a dependencies dictionary {head_id:[(dep_id, role)]}
     :type list_of_sentences: (dict[str,dict], dict[str,list[tuple]])
-    :return dictionary: dictionary of dictionaries {"lemma": { (lemma, pos): freq ..}}
+    :param int partitions: number of partitions the frequencies are split into
+    :param boolean binary_runs: write runs as binary records
+    :param str cache_dir: path to the folder of the corpus cache, None not to write it
+    :return list: paths of the sorted runs of lemma frequencies
     """
 
     file_id = uuid.uuid4()
-    lemma_freqdict = collections.defaultdict(int)
-    for sentence, _ in filter(lambda x: x is not None, list_of_sentences):
-        for token_id in sentence:
-            token = sentence[token_id]
-            lemma, pos = token["lemma"], token["upos"]
-            lemma_freqdict[(lemma,pos)] += 1
+    lemma_counter = dutils.SpillCounter(tmp_folder + "lemma-freqs-{}-{{run}}.p{{partition}}.gz".format(file_id),
+                                        format_key=_lemma_pos_bytes if binary_runs else " ".join,
+                                        partitions=partitions, binary=binary_runs)
+    cache = None if cache_dir is None else cutils.CorpusCacheWriter(cache_dir + "{}.gz".format(file_id))
+    for sentence, dependencies in filter(lambda x: x is not None, list_of_sentences):
+        lemma_counter.update((token.lemma, token.upos) for token in sentence.values())
+        if cache is not None:
+            cache.write(sentence, dependencies)
 
-    dict_of_dicts = {"lemma": lemma_freqdict}
+    if cache is not None:
+        cache.close()
 
-    for prefix, dic in dict_of_dicts.items():
-        sorted_freqdict = sorted(dic.items(), key = lambda x: x[0])
+    yield lemma_counter.close()
 
-        with gzip.open(tmp_folder+"{}-freqs-{}.gz".format(prefix, file_id), "wt") as fout:
-            for tup, freq in sorted_freqdict:
-                print("{}\t{}".format(" ".join(tup), freq), file=fout)
 
-    yield [tmp_folder+"lemma-freqs-{}.gz".format(file_id)]
+def _reduce_fn(tmp_folder, own_merge):
+    """
+    :return: function merging the runs of the workers. For merge_partitions, runs are only listed in a manifest
+    """
+    if own_merge:
+        return functools.partial(_collect_runs, tmp_folder)
+    return functools.partial(fmutils.merge_and_collapse_iterable, output_filename=None, tmpdir=tmp_folder,
+                             delete_input=True)
+
+
+def _collect_runs(tmp_folder, fnames):
+    runs = []
+    for fname in fnames:
+        if fname.endswith(".manifest"):
+            with open(fname) as fin:
+                runs.extend(line.strip() for line in fin)
+            os.remove(fname)
+        else:
+            runs.append(fname)
+
+    manifest_fname = tmp_folder + "runs-{}.manifest".format(uuid.uuid4())
+    with open(manifest_fname, "w") as fout:
+        for run in runs:
+            print(run, file=fout)
+
+    return manifest_fname
+
+
+def _merge_partition(runs, output_fname, batch_size, decode_key, finalize, min_freq):
+    if finalize is None:
+        written, below = dutils.merge_sorted_runs(runs, output_fname, decode_key=decode_key, min_freq=min_freq,
+                                                  batch_size=batch_size)
+    else:
+        written, below = dutils.merge_sorted_runs(runs, output_fname + ".merged", decode_key=decode_key,
+                                                  min_freq=min_freq, batch_size=batch_size)
+        finalize(output_fname + ".merged", output_fname)
+        os.remove(output_fname + ".merged")
+    return output_fname, written, below
+
+
+def merge_partitions(manifest_fname, output_fname, tmp_folder, workers, batch_size, decode_key=None, finalize=None,
+                     min_freq=0, ordered=True):
+    """
+    Merge the runs listed in a manifest, each partition by its own process, into the gzipped output file.
+
+    :param int batch_size: maximum number of runs open at once by each process
+    :param decode_key: function turning keys of binary runs into str, None for text runs
+    :param finalize: function applied to each merged partition, with paths of input and output file
+    :param boolean ordered: whether merged partitions are sorted by their final keys, so that they are merged again
+                            into a sorted output. Otherwise they are concatenated, and it is up to the caller to sort
+                            the output
+    :param int min_freq: keys with a lower merged frequency are not written
+    :return: number of keys written and number of keys below min_freq
+    """
+    partitions = collections.defaultdict(list)
+    with open(manifest_fname) as fin:
+        for line in fin:
+            run = line.strip()
+            partitions[dutils.run_partition(run)].append(run)
+    os.remove(manifest_fname)
+
+    tasks = [(runs, tmp_folder + "partition-{}.gz".format(partition), batch_size, decode_key, finalize, min_freq)
+             for partition, runs in sorted(partitions.items())]
+    logger.info("Merging {} partitions using {} workers".format(len(tasks), workers))
+
+    with multiprocessing.Pool(max(1, min(workers, len(tasks)))) as pool:
+        merged = pool.starmap(_merge_partition, tasks)
+
+    if ordered:
+        # partitions hold disjoint keys
+        dutils.merge_sorted_runs([fname for fname, _, _ in merged], output_fname, batch_size=batch_size)
+    else:
+        # gzip files can be concatenated
+        with open(output_fname, "wb") as fout:
+            for fname, _, _ in merged:
+                with open(fname, "rb") as fin:
+                    shutil.copyfileobj(fin, fout)
+                os.remove(fname)
+
+    return sum(written for _, written, _ in merged), sum(below for _, _, below in merged)
+
+
+def _write_prune_stats(fname, counter):
+    with open(fname, "w") as fout:
+        json.dump({"counted": counter.counted, "pruned_keys": counter.pruned_keys,
+                   "pruned_freq": counter.pruned_freq, "runs": counter.n_runs}, fout)
+
+
+def _prune_report(tmp_folder, prune_error, min_freq, written, below):
+    """
+    :return: totals of the pruning statistics written by the workers, with the bound of the frequency error and
+             the events left out of the output for being below min_freq
+    """
+    report = collections.Counter(counted=0, pruned_keys=0, pruned_freq=0, runs=0)
+    for fname in glob.glob(tmp_folder + "prune-stats-*.json"):
+        with open(fname) as fin:
+            report.update(json.load(fin))
+
+    report = dict(report)
+    report.update({"prune_error": prune_error, "max_error": int(prune_error * report.get("counted", 0)),
+                   "min_event_freq": min_freq, "written": written, "below_min_freq": below})
+    return report
 
 
 def events_manager(output_dir, input_paths, acceptable_labels, delimiter, batch_size_farm, batch_size_merge,
-                   e_thresh, w_thresh, lemmas_freqs_file, workers, associative_relations):
+                   e_thresh, w_thresh, lemmas_freqs_file, workers, associative_relations, max_batch_tokens=0,
+                   max_event_size=0, head_in_events=False, max_events_in_memory=0, partitions=1,
+                   binary_runs=False, prune_error=0, corpus_cache=False, min_event_freq=0):
+    """
+    :param int e_thresh: not applied by this extraction, which writes every event unless min_event_freq is set
+    :param int min_event_freq: events with a lower merged frequency are left out of the output, 0 to keep them all
+    """
 
     tmp_folder = tempfile.mkdtemp(dir=output_dir)+"/"
     accepted_pos, accepted_rels = dutils.load_acceptable_labels_from_file(acceptable_labels)
 
     accepted_lemmas = dutils.load_lemmapos_freqs(lemmas_freqs_file, w_thresh)
 
-    list_of_functions = [functools.partial(cutils.CoNLLReader, delimiter),
-                         functools.partial(cutils.DependencyBuilder, accepted_pos, accepted_rels),
-                         functools.partial(extract_patterns, tmp_folder, accepted_lemmas, associative_relations)]
+    # events are counted as tuples of integers, shared by all workers, and decoded once merged
+    manager = multiprocessing.Manager()
+    lemmas = vutils.Vocabulary(manager, accepted_lemmas)
+    relations = vutils.Vocabulary(manager)
+
+    # sentences are streamed in batches of at most batch_size_farm sentences and max_batch_tokens tokens,
+    # keeping only the dependencies that can make events
+    input_fnames = outils.get_filenames(input_paths)
+    reader = functools.partial(cutils.EventsReader, delimiter, accepted_pos, accepted_rels)
+    if corpus_cache:
+        cache_dir = _corpus_cache_dir(output_dir)
+        input_fnames = list(input_fnames)
+        if cutils.read_cache_manifest(cache_dir) == cutils.cache_manifest(input_fnames, accepted_pos, accepted_rels,
+                                                                          delimiter):
+            logger.info("Reading sentences from corpus cache {}".format(cache_dir))
+            input_fnames = sorted(glob.glob(cache_dir + "*.gz"))
+            reader = cutils.CacheReader
+        else:
+            logger.warning("No corpus cache of these input files and labels in {}, reading input files".format(
+                output_dir))
+
+    list_of_functions = [functools.partial(reader, accepted_lemmas, batch_size=batch_size_farm,
+                                           max_tokens=max_batch_tokens),
+                         functools.partial(extract_patterns, tmp_folder, accepted_lemmas, lemmas, relations,
+                                           associative_relations, max_event_size=max_event_size,
+                                           head_in_events=head_in_events, max_events_in_memory=max_events_in_memory,
+                                           partitions=partitions, binary_runs=binary_runs,
+                                           prune_error=prune_error)]
 
     conll_pip = putils.Farm(list_of_functions, workers, batch_size_farm)
-    reduce_fn = functools.partial(fmutils.merge_and_collapse_iterable, output_filename=None, tmpdir=tmp_folder,
-                                   delete_input=True)
+
+    # binary runs, the statistics of lossy counting and min_event_freq are only handled by merge_partitions
+    own_merge = partitions > 1 or binary_runs or prune_error > 0 or min_event_freq > 0
+    min_freq = min_event_freq
 
     start_time = time.time()
 
-    merged_fname = conll_pip.map_reduce(outils.get_filenames(input_paths), reduce_fn, batch_size_merge)
+    merged_fname = conll_pip.map_reduce(input_fnames, _reduce_fn(tmp_folder, own_merge), batch_size_merge)
 
     end_time = time.time()
     logger.info("Finished pipeline.run() and extract_patterns: time elapsed {} seconds".format(end_time-start_time))
 
     output_fname = output_dir+"/{}-freqs.gz".format("events")
+    # events are merged in order of their ids, which depends on the scheduling of the workers, and sorted once decoded
+    decoded_fname = tmp_folder + "events-freqs.decoded.gz"
+
+    decode = functools.partial(vutils.decode_events, lemmas=lemmas.items(), relations=relations.items())
+    if binary_runs:
+        # events are decoded while merging
+        written, below = merge_partitions(merged_fname, decoded_fname, tmp_folder, workers, batch_size_merge,
+                                          decode_key=vutils.EventDecoder(lemmas.items(), relations.items()),
+                                          min_freq=min_freq, ordered=False)
+    elif own_merge:
+        written, below = merge_partitions(merged_fname, decoded_fname, tmp_folder, workers, batch_size_merge,
+                                          finalize=decode, min_freq=min_freq, ordered=False)
+    else:
+        decode(merged_fname, decoded_fname)
+        os.remove(merged_fname)
+
+    dutils.sort_freqs(decoded_fname, output_fname, tmp_folder, max_events_in_memory or 1000000, batch_size_merge)
+
+    if prune_error > 0:
+        report = _prune_report(tmp_folder, prune_error, min_freq, written, below)
+        with open(output_dir+"/{}-freqs.prune.json".format("events"), "w") as fout:
+            json.dump(report, fout, indent=1)
+        logger.info("Lossy counting: {pruned_keys} counts of {counted} events left out of runs, frequencies "
+                    "underestimated by at most {max_error}; {written} events written, {below_min_freq} below "
+                    "{min_event_freq}".format(**report))
+
+    manager.shutdown()
+    shutil.rmtree(tmp_folder)
 
-    shutil.move (merged_fname, output_fname)
 
-    shutil.rmtree(tmp_folder)
+def powerset(iterable, max_size=0):
+    """
+    :return: subsets of at least 2 and at most max_size elements (0 for no limit)
+    """
+    max_size = min(max_size, len(iterable)) if max_size else len(iterable)
+    return itertools.chain.from_iterable(itertools.combinations(iterable, r) for r in range(2, max_size + 1))
 
 
-def powerset(iterable):
-    return itertools.chain.from_iterable(itertools.combinations(iterable, r) for r in range(2, len(iterable) + 1))
+def event_subsets(head, dependents, max_size=0, head_in_events=False):
+    """
+    :param head: member of the head, None if it is not a member
+    :param list dependents: members of the dependents
+    :param int max_size: maximum number of members of an event, 0 for no limit
+    :param boolean head_in_events: only count events including the head
+    :return: sorted tuples of members counted as events
+    """
+    if not head_in_events:
+        group = sorted(dependents if head is None else dependents + [head])
+        return powerset(group, max_size)
 
+    if head is None:
+        return []
+    dependents = sorted(dependents)
+    max_size = min(max_size - 1, len(dependents)) if max_size else len(dependents)
+    return (tuple(sorted(subset + (head,)))
+            for r in range(1, max_size + 1) for subset in itertools.combinations(dependents, r))
 
-def extract_patterns(tmp_folder, accepted_lemmas, associative_relations, list_of_sentences):
+
+def extract_patterns(tmp_folder, accepted_lemmas, lemmas, relations, associative_relations, list_of_sentences,
+                     max_event_size=0, head_in_events=False, max_events_in_memory=0, partitions=1,
+                     binary_runs=False, prune_error=0):
     """
 
     :param str tmp_folder: path to temporary folder
-    :param list_of_sentences: a tuple containing two objects: a words dictionary {token_id : {"lemma":lemma,"upos":pos}} and a dependencies dictionary {head_id:[(dep_id, role)]}
+    :param list_of_sentences: a tuple containing two objects: a words dictionary {token_id : Word} and a dependencies dictionary {head_id:[(dep_id, role)]}
     :type list_of_sentences: (dict[str,dict], dict[str,list[tuple]])
     :param set accepted_lemmas: a list of accepted lemmas in the form {token_ID : {'lemma': lemma, 'upos': pos}..}
+    :param Vocabulary lemmas: ids of (lemma, pos) tuples
+    :param Vocabulary relations: ids of relations
     :param boolean associative_relations:
-    :return list: list
+    :param int max_event_size: maximum number of members of an event, 0 for no limit
+    :param boolean head_in_events: only count events including the head
+    :param int max_events_in_memory: number of events counted in memory before they are written to a sorted run
+    :param int partitions: number of partitions the frequencies are split into
+    :param boolean binary_runs: write runs as binary records
+    :param float prune_error: error bound of lossy counting, 0 for exact counts
+    :return list: paths of the sorted runs of event frequencies
 
     """
 
     file_id = uuid.uuid4()
-    events_freqdict = collections.defaultdict(int)
+    events_counter = dutils.SpillCounter(tmp_folder + "events-freqs-{}-{{run}}.p{{partition}}.gz".format(file_id),
+                                         max_events_in_memory,
+                                         vutils.encode_event_bytes if binary_runs else vutils.encode_event,
+                                         partitions, binary_runs, prune_error)
 
     if associative_relations:
         associative_events_freqdict = collections.defaultdict(int)
@@ -134,46 +363,46 @@ def extract_patterns(tmp_folder, accepted_lemmas, associative_relations, list_of
 
         for head in dependencies:
             if head in sentence:
-                group = set()
-                if not len(accepted_lemmas) or (sentence[head]["lemma"], sentence[head]["upos"]) in accepted_lemmas:
-                    group.add("{}@{}@{}".format(sentence[head]["lemma"], sentence[head]["upos"], "HEAD"))
+                head_member = None
+                lemma_pos = (sentence[head].lemma, sentence[head].upos)
+                if not len(accepted_lemmas) or lemma_pos in accepted_lemmas:
+                    head_member = vutils.pack(lemmas[lemma_pos], relations["HEAD"])
 
+                dependents = set()
                 for dep in dependencies[head]:
                     ide = dep[0]
                     synrel = dep[1]
                     if ide in sentence:
-                        token = sentence[ide]
-                        if not len(accepted_lemmas) or (token["lemma"], token["upos"]) in accepted_lemmas:
-                            group.add("{}@{}@{}".format(token["lemma"], token["upos"], synrel))
+                        lemma_pos = (sentence[ide].lemma, sentence[ide].upos)
+                        if not len(accepted_lemmas) or lemma_pos in accepted_lemmas:
+                            dependents.add(vutils.pack(lemmas[lemma_pos], relations[synrel]))
                     else:
                         print("NOT FOUND IDE", ide)
 
-                group = list(sorted(group))
-                if len(group) < 16:
-                    groups.append(group)
+                if len(dependents) + (head_member is not None) < 16:
+                    events_counter.update(event_subsets(head_member, list(dependents), max_event_size,
+                                                        head_in_events))
+                    if associative_relations:
+                        groups.append(sorted(dependents if head_member is None else dependents | {head_member}))
             else:
                 print("HEAD NOT IN SENTENCE", head)
 
-    for group in groups:
-        subsets = powerset(group)
-        for subset in subsets:
-            events_freqdict[subset] += 1
-
     if associative_relations:
         for group1, group2 in itertools.combinations(groups, r=2):
-            cp = itertools.product([group1, group2])
+            cp = itertools.product(group1, group2)
             for el1, el2 in cp:
                 associative_events_freqdict[(min(el1, el2), max(el1, el2))] += 1
 
-    sorted_freqdict = sorted(events_freqdict.items(), key=lambda x: x[0])
-    with gzip.open(tmp_folder + "events-freqs-{}.gz".format(file_id), "wt") as fout:
-        for tup, freq in sorted_freqdict:
-            print("{}\t{}".format(" ".join(tup), freq), file=fout)
-
     if associative_relations:
+        # not merged with the events, so members are written decoded
+        decoder = vutils.EventDecoder(lemmas.items(), relations.items())
         sorted_freqdict = sorted(associative_events_freqdict.items(), key=lambda x: x[0])
         with gzip.open(tmp_folder + "associative-events-freqs-{}.gz".format(file_id), "wt") as fout:
             for tup, freq in sorted_freqdict:
-                print("{}\t{}".format(" ".join(tup), freq), file=fout)
+                print("{}\t{}".format(" ".join(decoder.member(member) for member in tup), freq), file=fout)
+
+    runs = events_counter.close()
+    if prune_error:
+        _write_prune_stats(tmp_folder + "prune-stats-{}.json".format(file_id), events_counter)
 
-    yield [tmp_folder + "events-freqs-{}.gz".format(file_id)]
\ No newline at end of file
+    yield runs
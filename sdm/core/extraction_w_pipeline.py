@@ -16,6 +16,7 @@ import time
 from sdm.utils import os_utils as outils
 from sdm.utils import data_utils as dutils
 from sdm.utils import corpus_utils as cutils
+from sdm.core import extraction_w_farm as seq_extraction
 from sdm.utils import Pipeline as putils
 from sdm.utils.FileMerger import filesmerger as fmutils
 
@@ -67,7 +68,7 @@ logger = logging.getLogger(__name__)
 
 
 def events_manager(output_dir, input_paths, acceptable_labels, delimiter, batch_size_list, e_thresh, w_thresh,
-                   lemmas_freqs_file, workers, associative_relations):
+                   lemmas_freqs_file, workers, associative_relations, max_event_size=0, head_in_events=False):
 
     tmp_folder = tempfile.mkdtemp(dir=output_dir)+"/"
     # tmp_folder_events = tempfile.mkdtemp(dir=output_dir)+"/"
@@ -80,9 +81,10 @@ def events_manager(output_dir, input_paths, acceptable_labels, delimiter, batch_
     state_class = fmutils.HierarchicalMerger(tmpdir=tmp_folder, delete_input=True)
 
     list_of_functions = [outils.get_filenames,
-                         functools.partial(cutils.CoNLLReader, delimiter, batch_size_list[2]),
+                         functools.partial(cutils.CoNLLReader, delimiter, batch_size=batch_size_list[2]),
                          functools.partial(cutils.DependencyBuilder, accepted_pos, accepted_rels),
-                         functools.partial(extract_patterns, tmp_folder, accepted_lemmas, associative_relations),
+                         functools.partial(extract_patterns, tmp_folder, accepted_lemmas, associative_relations,
+                                           max_event_size=max_event_size, head_in_events=head_in_events),
                          state_class.generator_add_for_pipeline]
 
     conll_pip = putils.Pipeline(list_of_functions, workers, batch_size_list)
@@ -116,7 +118,7 @@ def stats_manager(output_dir, input_paths, acceptable_labels, delimiter, batch_s
     state_class = fmutils.HierarchicalMerger(tmpdir=tmp_folder, delete_input=True)
 
     list_of_functions = [outils.get_filenames,
-                         functools.partial(cutils.CoNLLReader, delimiter, batch_size_list[2]),
+                         functools.partial(cutils.CoNLLReader, delimiter, batch_size=batch_size_list[2]),
                          functools.partial(cutils.DependencyBuilder, accepted_pos, accepted_rels),
                          functools.partial(extract_stats, tmp_folder),
                          state_class.generator_add_for_pipeline]
@@ -148,14 +150,17 @@ def powerset(iterable):
     return itertools.chain.from_iterable(itertools.combinations(iterable, r) for r in range(2, len(iterable) + 1))
 
   
-def extract_patterns(tmp_folder, accepted_lemmas, associative_relations, list_of_sentences):
+def extract_patterns(tmp_folder, accepted_lemmas, associative_relations, list_of_sentences, max_event_size=0,
+                     head_in_events=False):
     """
 
     :param str tmp_folder: path to temporary folder
-    :param list_of_sentences: a tuple containing two objects: a words dictionary {token_id : {"lemma":lemma,"upos":pos}} and a dependencies dictionary {head_id:[(dep_id, role)]}
+    :param list_of_sentences: a tuple containing two objects: a words dictionary {token_id : Word} and a dependencies dictionary {head_id:[(dep_id, role)]}
     :type list_of_sentences: (dict[str,dict], dict[str,list[tuple]])
     :param set accepted_lemmas: a list of accepted lemmas in the form {token_ID : {'lemma': lemma, 'upos': pos}..}
     :param boolean associative_relations:
+    :param int max_event_size: maximum number of members of an event, 0 for no limit
+    :param boolean head_in_events: only count events including the head
     :return list: list
 
     """
@@ -167,13 +172,16 @@ def extract_patterns(tmp_folder, accepted_lemmas, associative_relations, list_of
         associative_events_freqdict = collections.defaultdict(int)
 
     groups = []
+    # head member and dependent members of each group
+    events_groups = []
     for sentence, dependencies in filter(lambda x: x is not None, list_of_sentences):
 
         for head in dependencies:
             if head in sentence:
                 group = set()
-                if not len(accepted_lemmas) or (sentence[head]["lemma"], sentence[head]["upos"]) in accepted_lemmas:
-                    group.add("{}@{}@{}".format(sentence[head]["lemma"], sentence[head]["upos"], "HEAD"))
+                head_member = None
+                if not len(accepted_lemmas) or (sentence[head].lemma, sentence[head].upos) in accepted_lemmas:
+                    head_member = "{}@{}@{}".format(sentence[head].lemma, sentence[head].upos, "HEAD")
                 # print(dependencies[head])
                 # input()
 
@@ -182,26 +190,30 @@ def extract_patterns(tmp_folder, accepted_lemmas, associative_relations, list_of
                     synrel = dep[1]
                     if ide in sentence:
                         token = sentence[ide]
-                        if not len(accepted_lemmas) or (token["lemma"], token["upos"]) in accepted_lemmas:
+                        if not len(accepted_lemmas) or (token.lemma, token.upos) in accepted_lemmas:
                             # print("ADDING TOKEN", token)
-                            group.add("{}@{}@{}".format(token["lemma"], token["upos"], synrel))
+                            group.add("{}@{}@{}".format(token.lemma, token.upos, synrel))
                     else:
                         print("NOT FOUND IDE", ide)
                         # print("SENTENCE:", sentence)
 
+                dependents = list(group)
+                if head_member is not None:
+                    group.add(head_member)
                 group = list(sorted(group))
                 if len(group) < 16:
                     groups.append(group)
+                    events_groups.append((head_member, dependents))
                 # print("GROUP ADDED", groups)
 
             else:
                 print("HEAD NOT IN SENTENCE", head)
                 # print("SENTENCE:", sentence)
 
-    for group in groups:
+    for head_member, dependents in events_groups:
         # if len(group)>10:
         #     print(len(group), "-", group)
-        subsets = powerset(group)
+        subsets = seq_extraction.event_subsets(head_member, dependents, max_event_size, head_in_events)
         for subset in subsets:
             events_freqdict[subset] += 1
             # print(events_freqdict)
@@ -236,7 +248,7 @@ def extract_stats(tmp_folder, list_of_sentences):
     """
 
     :param str tmp_folder: path to temporary folder
-    :param list_of_sentences: a tuple containing two objects: a words dictionary {token_id : {"lemma":lemma,"upos":pos}} and a dependencies dictionary {head_id:[(dep_id, role)]}
+    :param list_of_sentences: a tuple containing two objects: a words dictionary {token_id : Word} and a dependencies dictionary {head_id:[(dep_id, role)]}
     :type list_of_sentences: (dict[str,dict], dict[str,list[tuple]])
     :return dictionary: dictionary of dictionaries {"lemma": { (lemma, pos): freq ..}}
     """
@@ -246,7 +258,7 @@ def extract_stats(tmp_folder, list_of_sentences):
     for sentence, _ in filter(lambda x: x is not None, list_of_sentences):
         for token_id in sentence:
             token = sentence[token_id]
-            lemma, pos = token["lemma"], token["upos"]
+            lemma, pos = token.lemma, token.upos
             lemma_freqdict[(lemma,pos)] += 1
 
     dict_of_dicts = {"lemma": lemma_freqdict}
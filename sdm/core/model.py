@@ -1,21 +1,24 @@
+import io
 import os
 import logging
+import multiprocessing
 import numpy as np
 
 import sdm.utils.data_utils as dutils
 import sdm.utils.weight_utils as wutils
 import sdm.utils.representation_utils as rutils
+import sdm.utils.trace_utils as tutils
 
 logger = logging.getLogger(__name__)
 
 
 def rerank(weighted_list, head_vector, ranking_function):
-    logger.info("list to re-rank: {}".format([x[0] for x in weighted_list]))
 
     new_list = ranking_function(weighted_list, head_vector)
-    new_list.sort(key=lambda x: -x[2])
-
-    logger.info("new list: {}".format([x[0] for x in new_list]))
+    if isinstance(new_list, rutils.WeightedList):
+        new_list = new_list.ranked()
+    else:
+        new_list.sort(key=lambda x: -x[2])
 
     return new_list
 
@@ -24,25 +27,15 @@ class LinguisticConditions:
     def __init__(self, sdm):
         self.sdm = sdm
         self.content = {r: [] for r in self.sdm.relations}
-        logger.info("Initializing LC: {}".format(self.content))
 
     def update(self, rel, vector, label):
-        print("* previous LC:", file=self.sdm.log_file)
-        for el in self.content:
-            print("\t{} - {}".format(el, " ".join(x[0] for x in self.content[el])), file=self.sdm.log_file)
-
         self.content[rel].append((label, vector))
 
-        print("* current LC:", file=self.sdm.log_file)
-        for el in self.content:
-            print("\t{} - {}".format(el, " ".join(x[0] for x in self.content[el])), file=self.sdm.log_file)
-
-        logger.info("Updating LC: {}".format(self.content[rel]))
+        if self.sdm.trace.full:
+            self.sdm.trace.write("LC", content={r: [x[0] for x in self.content[r]] for r in self.content})
 
     def get_vector(self, target_relation):
 
-        logger.info("Returning LC vector for relation {}".format(target_relation))
-
         if target_relation == 'SENTENCE':
             vectors = []
             for relation in self.content:
@@ -61,76 +54,75 @@ class ActiveContext:
     def __init__(self, sdm):
         self.sdm = sdm
         self.content = {r: [] for r in self.sdm.relations}
-        logger.info("Initializing AC: {}".format(self.content))
 
-    def update(self, GEK_portion):
+        # With centroids, the sum of the centroids of the sublists of each relation is kept up to date as portions
+        # are appended, and only recomputed (from the centroids cached in each sublist) when a rerank changes the
+        # top-M elements of a sublist.
+        self.incremental = self.sdm.get_representation_function is rutils._centroid
+        self.centroids_sum = {r: None for r in self.sdm.relations}
+        self.dirty = {r: False for r in self.sdm.relations}
 
-        print("* previous AC:", file=self.sdm.log_file)
-        for relation in self.content:
-            substr = ''
-            for sublist in self.content[relation]:
-                substr += ", ".join(x[0] for x in sublist)
-                substr += " || "
-            print("\t{} - {}".format(relation, substr), file=self.sdm.log_file)
+    def get_relation_vector(self, relation):
+        if not self.incremental:
+            return self.sdm.get_representation_function(self.content[relation], self.sdm.M)
+
+        if self.dirty[relation]:
+            self.centroids_sum[relation] = np.sum([sublist.head_centroid(self.sdm.M)
+                                                   for sublist in self.content[relation]], axis=0)
+            self.dirty[relation] = False
 
-        logger.info("Updating AC...")
+        if self.centroids_sum[relation] is None:
+            return None
+        return self.centroids_sum[relation] / len(self.content[relation])
+
+    def update(self, GEK_portion):
 
         for relation in self.content:
-            logger.info("Examining relation {}".format(relation))
 
             if self.sdm.rank_forward:
-                print("* computing centroid of AC content for relation {}".format(relation))
-                head_content = self.sdm.get_representation_function(self.content[relation], self.sdm.M)
-                logger.info("Head_content computed: {}".format(head_content))
+                head_content = self.get_relation_vector(relation)
 
                 if head_content is not None:
-                    logger.info("Re-ranking GEK_portion with respect to head_content")
                     GEK_portion[relation] = rerank(GEK_portion[relation], head_content, self.sdm.weight_function)
 
             if self.sdm.rank_backward:
-                print("* computing centroid of GEK portion content for relation {}".format(relation))
                 head_GEK = self.sdm.get_representation_function([GEK_portion[relation]], self.sdm.M)
-                logger.info("Head_GEK computed: {}".format(head_GEK))
 
                 if head_GEK is not None:
-                    logger.info("Re-ranking AC content with respect to head_GEK")
                     new_content = []
                     for sublist in self.content[relation]:
-                        new_content.append(rerank(sublist, head_GEK, self.sdm.weight_function))
+                        new_sublist = rerank(sublist, head_GEK, self.sdm.weight_function)
+                        if self.incremental and \
+                                new_sublist.head_centroid(self.sdm.M) is not sublist.head_centroid(self.sdm.M):
+                            self.dirty[relation] = True
+                        new_content.append(new_sublist)
                     self.content[relation] = new_content
 
-                    logger.info("new content for relation {}: "
-                                "{}".format(relation, [[x[0] for x in sublist] for sublist in self.content[relation]]))
-
-            logger.info("Appending GEK_portion to content for relation {}".format(relation))
-
             if len(GEK_portion[relation]) > 0:
                 self.content[relation].append(GEK_portion[relation])
-            else:
-                logger.info("GEK portion empty")
-                # input()
+                if self.incremental and not self.dirty[relation]:
+                    centroid = GEK_portion[relation].head_centroid(self.sdm.M)
+                    if self.centroids_sum[relation] is None:
+                        self.centroids_sum[relation] = centroid.copy()
+                    else:
+                        self.centroids_sum[relation] += centroid
 
-        print("* current AC:", file=self.sdm.log_file)
-        for relation in self.content:
-            substr = ''
-            for sublist in self.content[relation]:
-                substr += ", ".join(x[0] for x in sublist)
-                substr += " || "
-            print("\t{} - {}".format(relation, substr), file=self.sdm.log_file)
+        if self.sdm.trace.full:
+            self.sdm.trace.write("AC", content={r: [list(sublist.labels) for sublist in self.content[r]]
+                                                for r in self.content})
 
     def get_vector(self, target_relation):
-        logger.info("Returning AC vector for relation {}".format(target_relation))
 
         if target_relation == 'SENTENCE':
             vectors = []
             for relation in self.content:
-                ret = self.sdm.get_representation_function(self.content[relation], self.sdm.M)
+                ret = self.get_relation_vector(relation)
                 if ret is not None:
                     vectors.append(ret)
             ret = np.sum(vectors, axis=0)
             return ret / len(vectors)
         else:
-            ret = self.sdm.get_representation_function(self.content[target_relation], self.sdm.M)
+            ret = self.get_relation_vector(target_relation)
             return ret
 
 
@@ -141,7 +133,7 @@ class StructuredDistributionalModel:
         logger.info("Initializing new structured distributional model")
         logger.info("setting SDM global parameters")  # TODO: add full dump of parameters
 
-        self.graph = graph.session()
+        self.graph = graph
         self.rel_map = relations_map
         self.vector_space = vectors
 
@@ -155,106 +147,74 @@ class StructuredDistributionalModel:
 
         self.weight_to_extract = weight_to_extract
 
-        self.log_file = None
+        self.trace = None
         self.relations = None
         self.LC, self.AC = None, None
 
-    def new_item(self, relations_list, log_fout_handler):
-        logger.info("Initializing new SDM item")
+    def new_item(self, relations_list, trace):
 
-        self.log_file = log_fout_handler
+        self.trace = trace
         self.relations = relations_list
-        print("RELATIONS: {}".format(self.relations), file=self.log_file)
         self.LC = LinguisticConditions(self)
         self.AC = ActiveContext(self)
 
     def process(self, form, pos, rel):
 
-        logger.info("processing element {} - {} - {}".format(form, pos, rel))
-
         if form in self.vector_space:
-            print("[STEP1: EXTRACTING GEK for {}@{}@{}]".format(form, pos, rel), file=self.log_file)
             GEK = self.extract_GEK(form, rel, pos)
-            print("[STEP2: UPDATING LC for {}@{}@{}]".format(form, pos, rel), file=self.log_file)
+            if self.trace.full:
+                self.trace.write("word", word="{}@{}@{}".format(form, pos, rel),
+                                 GEK={r: list(GEK[r].labels) for r in GEK})
+            elif self.trace.summary:
+                self.trace.write("word", word="{}@{}@{}".format(form, pos, rel),
+                                 GEK={r: len(GEK[r]) for r in GEK})
             self.LC.update(rel, self.vector_space[(form, pos)], form)
-            print("[STEP3: UPDATING AC for {}@{}@{}]".format(form, pos, rel), file=self.log_file)
             self.AC.update(GEK)
-        else:
-            logger.info("WARNING: element not in vector space")
-            print("[WARNING]: element {} not in vector space".format(form), file=self.log_file)
+        elif self.trace.summary:
+            self.trace.write("word", word="{}@{}@{}".format(form, pos, rel), in_vector_space=False)
+
+    def gek_requests(self, form, pos, rel, relations):
+        """
+        :return: the box relations to be queried in the graph for word form@pos@rel,
+                 and the corresponding requests for the GEK backend
+        """
+        box_relations = [box_relation for box_relation in relations if not box_relation == rel]
+        requests = [(form, pos, self.rel_map[rel], self.rel_map[box_relation]) for box_relation in box_relations]
+        return box_relations, requests
+
+    def prefetch(self, dataset, batch_size):
+        """Query the graph for all the words of the dataset at once, filling the GEK cache."""
+
+        requests = []
+        for elements, _, ac_content in dataset:
+            for form, pos, rel in elements:
+                if form in self.vector_space:
+                    requests.extend(self.gek_requests(form, pos, rel, ac_content)[1])
+
+        self.graph.prefetch(requests, self.N, self.weight_to_extract, batch_size)
 
     def extract_GEK(self, form, rel, pos):
 
         GEK = {}
-        logger.info("GEK portion initialized: {}".format(GEK))
 
-        for box_relation in self.relations:
+        box_relations, requests = self.gek_requests(form, pos, rel, self.relations)
+        extracted = dict(zip(box_relations, self.graph.top_k_batch(requests, self.N, self.weight_to_extract)))
 
-            logger.info("extracting knowledge for label {}".format(box_relation))
+        for box_relation in self.relations:
 
             GEK[box_relation] = []
             if box_relation == rel:
-                logger.info("label {} is equal to relation {}".format(box_relation, rel))
                 if self.include_same_relations:
                     # TODO: do we normalize the PMI between 0 and 1 always?
                     GEK[box_relation].append((form, self.vector_space[(form, pos)], 1))
-                    logger.info("Adding {} as GEK for label {}".format(form, box_relation))
             else:
-                none_in_list_in = 'None' in self.rel_map[rel]
-                list_in_wo_none = [x for x in self.rel_map[rel] if not x == 'None']
-
-                none_in_list_out = 'None' in self.rel_map[box_relation]
-                list_out_wo_none = [x for x in self.rel_map[box_relation] if not x == 'None']
-
-                query_str_prefix = "MATCH (n:words {form:$form, POS:$pos}) - [a:args] - (e:events) - [a2:args] - (m:words) "
-                query_str_middle = "WHERE NOT m.form IN ['LOCATION', 'PERSON', 'ORGANIZATION'] "
-                query_str_suffix = ""
-
-                if self.weight_to_extract == 'pmi':
-                    query_str_suffix = " RETURN n.form, a.role, a2.role, sum(a2.pmi) AS PMI, m.form, m.POS " \
-                                       " ORDER BY PMI DESC " \
-                                       " LIMIT $K "
-                elif self.weight_to_extract == "lmi":
-                    query_str_suffix = " RETURN n.form, a.role, a2.role, sum(a2.pmi*a2.freq) AS PMI, m.form, m.POS " \
-                                       " ORDER BY PMI DESC " \
-                                       " LIMIT $K "
-
-                if none_in_list_in:
-                    query_str_middle += "AND (a.role in $forms_in OR a.role is null) "
-                else:
-                    query_str_middle += "AND (a.role in $forms_in) "
-
-                if none_in_list_out:
-                    query_str_middle += "AND (a2.role in $forms_out OR a2.role is null)"
-                else:
-                    query_str_middle += "AND (a2.role in $forms_out) "
-
-                query = query_str_prefix+query_str_middle+query_str_suffix
-                logger.info("performing query: {}".format(query))
-                logger.info("PARAMETERS: form={}, pos={}, role={}, forms_in={}, "
-                            "forms_out={}, K={}".format(form, pos, rel, list_in_wo_none, list_out_wo_none, self.N))
-                # input()
-
-                data = self.graph.run(query,
-                                      form=form, pos=pos, role=rel,
-                                      forms_in=list_in_wo_none, forms_out=list_out_wo_none,
-                                      K=self.N)
-
-                for el in data.data():
+                for el_form, el_pos, pmi in extracted[box_relation]:
                     # TODO: how to have N words if something is not in vector space?
-                    el_form = el["m.form"]
-                    el_pos = el["m.POS"]
-                    logger.info("extracted word {}".format(el_form))
                     if el_form in self.vector_space:
                         el_form_v = self.vector_space[(el_form, el_pos)]
-                        pmi = el["PMI"]
                         GEK[box_relation].append((el_form, el_form_v, pmi))
-                    else:
-                        logger.info("word not in vector space")
 
-            logger.info("GEK for label {}: {}".format(box_relation, [(x[0], x[2]) for x in GEK[box_relation]]))
-            print("* GEK for label {}:".format(box_relation), file=self.log_file)
-            print("\t"+", ".join(x[0] for x in GEK[box_relation]), file=self.log_file)
+            GEK[box_relation] = rutils.WeightedList.from_items(GEK[box_relation])
 
         return GEK
 
@@ -266,12 +226,48 @@ class StructuredDistributionalModel:
         return LC_vector, AC_vector
 
 
+def _process_item(sdm, item, trace):
+    elements, object_relation, ac_content = item
+    if trace.summary:
+        trace.write("item", item=" ".join("@".join(el) for el in elements), target=object_relation,
+                    relations=sorted(ac_content))
+    sdm.new_item(ac_content, trace)
+
+    for word in elements:
+
+        form, pos, rel = word
+        sdm.process(form, pos, rel)
+
+    return sdm.get_vector(object_relation)
+
+
+# model and trace level of each worker process, inherited from the parent process when forking
+_worker_sdm = None
+_worker_trace_level = tutils.OFF
+
+
+def _init_worker(sdm, trace_level):
+    global _worker_sdm, _worker_trace_level
+    _worker_sdm = sdm
+    _worker_sdm.graph = sdm.graph.clone()
+    _worker_trace_level = trace_level
+
+
+def _process_item_in_worker(item):
+    trace_fout = io.StringIO()
+    lc_vector, ac_vector = _process_item(_worker_sdm, item, tutils.Trace(trace_fout, _worker_trace_level))
+    # GEK retrieved by the worker goes back to the parent, whose cache is the one saved
+    return lc_vector, ac_vector, trace_fout.getvalue(), _worker_sdm.graph.take_updates()
+
+
 def build_representation(output_path, graph, relations_fpath, data_fpaths, vector_space,
                          weight_function, rank_forward, rank_backward, N, M,
-                         include_same_relations, representation_function, weight_to_extract):
+                         include_same_relations, representation_function, weight_to_extract,
+                         prefetch_batch_size=0, workers=1, trace_level="off", binary_output=False):
 
     f_weight_function = wutils.possible_functions[weight_function]
     f_representation_function = rutils.possible_functions[representation_function]
+    trace_level = tutils.levels[trace_level]
 
     relations_map = dutils.load_mapping(relations_fpath)
     vectors = vector_space
@@ -283,26 +279,55 @@ def build_representation(output_path, graph, relations_fpath, data_fpaths, vecto
                                         representation_function=f_representation_function,
                                         weight_to_extract=weight_to_extract)
 
-    for filename in data_fpaths:
-        log_fname = output_path + os.path.basename(filename) + ".log"
-
-        with open(log_fname, "w", buffering=1) as log_fout:
+    datasets = [dutils.load_dataset(filename) for filename in data_fpaths]
+
+    pool = results = None
+    if workers > 1:
+        # workers inherit the vector space and the prefetched GEK, and get their own connection to the graph.
+        # Items of all files are submitted at once, results come back in input order.
+        if prefetch_batch_size > 0:
+            for dataset in datasets:
+                sdm.prefetch(dataset, prefetch_batch_size)
+        pool = multiprocessing.get_context("fork").Pool(workers, initializer=_init_worker,
+                                                    initargs=(sdm, trace_level))
+        results = [pool.imap(_process_item_in_worker, dataset, chunksize=max(1, len(dataset) // (4 * workers)))
+                   for dataset in datasets]
+
+    try:
+        _write_representations(output_path, sdm, data_fpaths, datasets, results,
+                               prefetch_batch_size, trace_level, binary_output)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _write_representations(output_path, sdm, data_fpaths, datasets, results, prefetch_batch_size, trace_level,
+                           binary_output):
+    """
+    :param results: iterators over the results of the workers for each dataset, None to process items in this process
+    """
+    for i, (filename, dataset) in enumerate(zip(data_fpaths, datasets)):
+        trace_fname = output_path + os.path.basename(filename) + ".trace.jsonl"
+        if trace_level == tutils.OFF:
+            trace_fname = os.devnull
+
+        with open(trace_fname, "w") as trace_fout:
             out_fname = output_path+os.path.basename(filename)+".out"
-            dataset = dutils.load_dataset(filename)
             res = []
-            for item in dataset:
-                logger.info("Processing dataset item: {}".format(item))
-                print("## Processing dataset item: {} ##".format(item), file=log_fout)
-                elements, object_relation, ac_content = item
-                sdm.new_item(ac_content, log_fout)
-
-                for word in elements:
-
-                    form, pos, rel = word
-                    sdm.process(form, pos, rel)
-
-                print("Printing vectors in output", file=log_fout)
-                lc_vector, ac_vector = sdm.get_vector(object_relation)
-                res.append((lc_vector, ac_vector))
+            if results is not None:
+                for lc_vector, ac_vector, trace, gek_updates in results[i]:
+                    trace_fout.write(trace)
+                    if gek_updates is not None:
+                        sdm.graph.merge_updates(gek_updates)
+                    res.append((lc_vector, ac_vector))
+            else:
+                if prefetch_batch_size > 0:
+                    sdm.prefetch(dataset, prefetch_batch_size)
+                trace = tutils.Trace(trace_fout, trace_level)
+                for item in dataset:
+                    res.append(_process_item(sdm, item, trace))
 
         dutils.dump_results(filename, res, out_fname)
+        if binary_output:
+            dutils.dump_results_binary(res, out_fname)
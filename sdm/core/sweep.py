@@ -0,0 +1,112 @@
+import logging
+import itertools
+import numpy as np
+import pandas as pd
+from scipy.stats import spearmanr, rankdata
+
+import sdm.core.model as model
+import sdm.core.evaluation as evaluation
+import sdm.utils.data_utils as dutils
+import sdm.utils.weight_utils as wutils
+import sdm.utils.representation_utils as rutils
+import sdm.utils.trace_utils as tutils
+
+logger = logging.getLogger(__name__)
+
+# rank_forward, rank_backward
+RANKINGS = {"both": (True, True), "forward": (True, False), "backward": (False, True), "none": (False, False)}
+
+
+def bootstrap_spearman(x, y, n_resamples, confidence, seed=None):
+    """
+    :return: Spearman's correlation between x and y, its p-value and the bounds of its bootstrap confidence interval.
+             Resamples are the rows of a matrix, which are ranked and correlated all at once.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    rho, pvalue = spearmanr(x, y)
+
+    if n_resamples == 0:
+        return rho, pvalue, np.nan, np.nan
+
+    samples = np.random.RandomState(seed).randint(0, len(x), size=(n_resamples, len(x)))
+    ranks_x = rankdata(x[samples], axis=1)
+    ranks_y = rankdata(y[samples], axis=1)
+    ranks_x -= ranks_x.mean(axis=1, keepdims=True)
+    ranks_y -= ranks_y.mean(axis=1, keepdims=True)
+
+    # resamples with constant ranks have no correlation and are left out
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rhos = (ranks_x * ranks_y).sum(axis=1) / np.sqrt((ranks_x ** 2).sum(axis=1) * (ranks_y ** 2).sum(axis=1))
+
+    alpha = (1 - confidence) / 2
+    low, high = np.nanpercentile(rhos, [100 * alpha, 100 * (1 - alpha)])
+    return rho, pvalue, low, high
+
+
+def ks_evaluator(eval_data_fpath, mapping_fpath, dataset, vectors):
+    ids, rows1, rows2 = evaluation.load_ks_mapping(mapping_fpath)
+    scores = pd.read_csv(eval_data_fpath, delimiter="\t")["score"].loc[ids].values
+
+    def similarities(AC_vectors, AC_mask):
+        return evaluation.ks_similarities(AC_vectors, rows1, rows2, AC_mask)
+
+    return scores, similarities
+
+
+def dtfit_evaluator(eval_data_fpath, mapping_fpath, dataset, vectors):
+    data = pd.read_csv(eval_data_fpath, delimiter="\t")
+    rows, target_vectors = evaluation.dtfit_targets(data, [item[1] for item in dataset], vectors)
+    scores = data["mean_rat"].loc[rows].values
+
+    def similarities(AC_vectors, AC_mask):
+        return evaluation.dtfit_similarities(AC_vectors, rows, target_vectors, AC_mask)
+
+    return scores, similarities
+
+
+evaluators = {"ks": ks_evaluator, "dtfit": dtfit_evaluator}
+
+
+def sweep(output_fpath, graph, relations_fpath, data_fpath, vector_space, eval_data_fpath, data_type, mapping_fpath,
+          Ns, Ms, weights, rankings, weight_function, representation_function, include_same_relations,
+          prefetch_batch_size=0, n_resamples=1000, confidence=0.95, seed=None):
+    """
+    Build the representations of the dataset for each combination of N, M, weight and ranking, evaluate them and
+    write one row per combination to output_fpath.
+    Vectors are loaded once, and the largest N is queried first for each weight, so that the GEK of smaller N's
+    is served by the GEK cache.
+    """
+
+    f_weight_function = wutils.possible_functions[weight_function]
+    f_representation_function = rutils.possible_functions[representation_function]
+
+    relations_map = dutils.load_mapping(relations_fpath)
+    dataset = dutils.load_dataset(data_fpath)
+    scores, similarities = evaluators[data_type](eval_data_fpath, mapping_fpath, dataset, vector_space)
+    trace = tutils.Trace(None, tutils.OFF)
+
+    results = []
+    for N, weight in itertools.product(sorted(set(Ns), reverse=True), weights):
+        for i, (M, ranking) in enumerate(itertools.product(Ms, rankings)):
+            rank_forward, rank_backward = RANKINGS[ranking]
+            sdm = model.StructuredDistributionalModel(graph=graph, relations_map=relations_map, vectors=vector_space,
+                                                      weight_function=f_weight_function, rank_forward=rank_forward,
+                                                      rank_backward=rank_backward, N=N, M=M,
+                                                      include_same_relations=include_same_relations,
+                                                      representation_function=f_representation_function,
+                                                      weight_to_extract=weight)
+            if prefetch_batch_size > 0 and i == 0:
+                sdm.prefetch(dataset, prefetch_batch_size)
+
+            res = [model._process_item(sdm, item, trace) for item in dataset]
+            _, AC_vectors, mask = dutils.results_matrices(res)
+            valid_scores, sim_scores = evaluation.valid_pairs(scores, similarities(AC_vectors, mask[:, 1]))
+
+            rho, pvalue, low, high = bootstrap_spearman(valid_scores, sim_scores, n_resamples, confidence, seed)
+            logger.info("N={}, M={}, weight={}, ranking={}: Spearman's correlation {:.4f} "
+                        "[{:.4f}, {:.4f}]".format(N, M, weight, ranking, rho, low, high))
+            results.append((N, M, weight, ranking, len(valid_scores), rho, pvalue, low, high))
+
+    columns = ["N", "M", "weight", "ranking", "items", "spearman", "pvalue", "ci_low", "ci_high"]
+    pd.DataFrame(results, columns=columns).to_csv(output_fpath, sep="\t", index=False)
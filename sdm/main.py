@@ -11,12 +11,14 @@ import sdm.utils.config as cutils
 import sdm.utils.graph_utils as gutils
 import sdm.utils.os_utils as outils
 import sdm.utils.data_utils as dutils
+import sdm.utils.gek_utils as gekutils
 
 import sdm.core.datasets as datasets
 import sdm.core.model as model
 import sdm.core.extraction_w_pipeline as extraction
 import sdm.core.extraction_w_farm as seq_extraction
 import sdm.core.evaluation as evaluation
+import sdm.core.sweep as sweep
 
 config_dict = cutils.load(os.path.join(os.path.dirname(__file__), "logging_utils", "logging.yml"))
 logging.config.dictConfig(config_dict)
@@ -35,6 +37,15 @@ def _sequential_extraction(args):
     acceptable_labels = args.labels
     batch_size_farm = args.batch_size_input
     batch_size_merge = args.batch_size_merge
+    max_batch_tokens = args.max_batch_tokens
+    max_event_size = args.max_event_size
+    head_in_events = args.head_in_events
+    max_events_in_memory = args.max_events_in_memory
+    partitions = args.partitions
+    binary_runs = args.binary_runs
+    prune_error = args.prune_error
+    min_event_freq = args.min_event_freq
+    corpus_cache = args.corpus_cache
     workers = args.workers
     w_thresh = args.word_thresh
     e_thresh = args.event_thresh
@@ -52,12 +63,18 @@ def _sequential_extraction(args):
         if stats:
             logger.info("Extracting stats")
             lemmas_freqs_file = seq_extraction.stats_manager(output_path, input_paths, acceptable_labels, delimiter,
-                                                             batch_size_farm, batch_size_merge, w_thresh, workers)
+                                                             batch_size_farm, batch_size_merge, w_thresh, workers,
+                                                             max_batch_tokens=max_batch_tokens, partitions=partitions,
+                                                             binary_runs=binary_runs, corpus_cache=corpus_cache)
         if events:
             logger.info("Extracting events using {} workers".format(workers))
             seq_extraction.events_manager(output_path, input_paths, acceptable_labels, delimiter,
                                           batch_size_farm, batch_size_merge, e_thresh, w_thresh, lemmas_freqs_file, workers,
-                                          associative_events)
+                                          associative_events, max_batch_tokens=max_batch_tokens,
+                                          max_event_size=max_event_size, head_in_events=head_in_events,
+                                          max_events_in_memory=max_events_in_memory, partitions=partitions,
+                                          binary_runs=binary_runs, prune_error=prune_error,
+                                          corpus_cache=corpus_cache, min_event_freq=min_event_freq)
 
     elif pipeline == "stream":
         extraction.StreamPipeline(output_path)
@@ -73,6 +90,8 @@ def _pipeline_extraction(args):
     w_thresh = args.word_thresh
     e_thresh = args.event_thresh
     lemmas_freqs_file = args.lemmas_freqs_filepath
+    max_event_size = args.max_event_size
+    head_in_events = args.head_in_events
     associative_events = False
 
     pipeline = args.pipeline
@@ -90,7 +109,8 @@ def _pipeline_extraction(args):
         if events:
             logger.info("Extracting events")
             extraction.events_manager(output_path, input_paths, acceptable_labels, delimiter,
-                                      batch_size_list, e_thresh, w_thresh, lemmas_freqs_file, workers, associative_events)
+                                      batch_size_list, e_thresh, w_thresh, lemmas_freqs_file, workers, associative_events,
+                                      max_event_size=max_event_size, head_in_events=head_in_events)
 
         # extraction.launchCoNLLPipeline(output_path, input_paths, acceptable_labels,
         #                                delimiter, batch_size_s, batch_size_e,
@@ -107,6 +127,15 @@ def _build_graph(args):
     gutils.write_graph(lemma_f_path, event_f_path, output_path)
 
 
+def _build_gek_index(args):
+    output_path = outils.check_dir(args.output_dir)
+    graph_dir = args.graph_dir
+    relations_fpath = args.relations
+    _N = args.N_from_graph
+    weights = args.weights
+    gekutils.write_gek_index(graph_dir, relations_fpath, output_path, _N, weights)
+
+
 def _import_graph(args):
     neo_folder = args.neo
     data_folder = args.data
@@ -136,6 +165,23 @@ def _prepare_input(args):
     datasets.prepare_input_files(data, outfolder, datatype, outtype)
 
 
+def _convert_vectors(args):
+    vector_fpath = args.vectors
+    output_fpath = args.output
+    lemmas_freqs_fpath = args.lemmas_freqs_filepath
+    w_thresh = args.word_thresh
+    vectors_with_PoS = args.vectors_with_PoS
+    reduced_vec_len = args.reduced_vec_len
+    dtype = args.dtype
+
+    if not output_fpath.endswith(".npy"):
+        output_fpath += ".npy"
+    outils.check_dir(os.path.dirname(os.path.abspath(output_fpath)))
+
+    dutils.convert_vectors(vector_fpath, output_fpath, lemmas_freqs_fpath=lemmas_freqs_fpath, thresh=w_thresh,
+                           withPoS=vectors_with_PoS, len_vectors=reduced_vec_len, dtype=dtype)
+
+
 def _compute_evaluation(args):
     output_path = outils.check_dir(args.output_dir)
     original_data = args.data
@@ -146,11 +192,46 @@ def _compute_evaluation(args):
     evaluation.compute_evaluation(original_data, generated_data, output_path, vecs, mapfile, data_type)
 
 
-def _build_representations(args):
-    output_path = outils.check_dir(args.output_dir)
+def _load_graph(args):
+    """
+    :return: the GEK backend selected by the graph arguments, wrapped in the GEK cache unless it is disabled,
+             and the batch size used to prefetch queries
+    """
     uri = args.uri
     username = args.user
     password = args.password
+    graph_dir = args.graph_dir
+    gek_index = args.gek_index
+    gek_cache_size = args.gek_cache_size
+    gek_cache_fpath = args.gek_cache_file
+    prefetch_batch_size = args.prefetch_batch_size
+    async_queries = args.async_queries
+
+    if gek_index:
+        graph = gekutils.GEKIndex(gek_index)
+    elif graph_dir:
+        graph = gekutils.LocalGEK(graph_dir)
+    elif async_queries > 0:
+        graph = gekutils.AsyncNeo4jGEK(uri, username, password, async_queries)
+        # queries are kept in flight while prefetching
+        if prefetch_batch_size == 0:
+            prefetch_batch_size = 1
+    else:
+        graph = gekutils.Neo4jGEK(uri, username, password)
+
+    if gek_cache_size > 0:
+        graph = gekutils.GEKCache(graph, gek_cache_size, gek_cache_fpath)
+    elif prefetch_batch_size > 0:
+        logger.warning("Prefetching needs the GEK cache, queries will not be prefetched")
+        prefetch_batch_size = 0
+
+    return graph, prefetch_batch_size
+
+
+def _build_representations(args):
+    output_path = outils.check_dir(args.output_dir)
+    gek_cache_size = args.gek_cache_size
+    workers = args.workers
     relations_fpath = args.relations
     data_fpaths = args.data
     vector_fpath = args.vectors
@@ -164,20 +245,73 @@ def _build_representations(args):
     include_same_relations = args.include_same_relations
     reduced_vec_len = args.reduced_vec_len
     vectors_with_PoS = args.vectors_with_PoS
+    mmap_vectors = args.mmap_vectors
+    trace_level = args.trace
+    binary_output = args.binary_output
 
     weight_to_extract = args.weight_from_graph
 
-    graph = gutils.connect_to_graph(uri, username, password)
+    graph, prefetch_batch_size = _load_graph(args)
 
     vector_space = dutils.load_vectors(vector_fpath, withPoS=vectors_with_PoS,
-                                       len_vectors=reduced_vec_len)
+                                       len_vectors=reduced_vec_len, mmap=mmap_vectors)
 
     model.build_representation(output_path=output_path, graph=graph, relations_fpath=relations_fpath,
                                data_fpaths=data_fpaths, vector_space=vector_space,
                                weight_function=weight_function, rank_forward=rank_forward, rank_backward=rank_backward,
                                N=_N, M=_M, include_same_relations=include_same_relations,
                                representation_function=representation_function,
-                               weight_to_extract=weight_to_extract)
+                               weight_to_extract=weight_to_extract, prefetch_batch_size=prefetch_batch_size,
+                               workers=workers, trace_level=trace_level, binary_output=binary_output)
+
+    if gek_cache_size > 0:
+        graph.log_stats()
+        graph.save()
+    graph.close()
+
+
+def _sweep(args):
+    output_path = outils.check_dir(args.output_dir)
+    gek_cache_size = args.gek_cache_size
+    relations_fpath = args.relations
+    data_fpath = args.data
+    vector_fpath = args.vectors
+    eval_data_fpath = args.eval_data
+    data_type = args.type
+    mapping_fpath = args.map
+
+    weight_function = args.weight_function
+    representation_function = args.representation_function
+    include_same_relations = args.include_same_relations
+    reduced_vec_len = args.reduced_vec_len
+    vectors_with_PoS = args.vectors_with_PoS
+    mmap_vectors = args.mmap_vectors
+
+    Ns = args.N_from_graph
+    Ms = args.M_build_rep
+    weights = args.weight_from_graph
+    rankings = args.ranking
+    n_resamples = args.bootstrap
+    confidence = args.confidence
+    seed = args.seed
+
+    graph, prefetch_batch_size = _load_graph(args)
+
+    vector_space = dutils.load_vectors(vector_fpath, withPoS=vectors_with_PoS,
+                                       len_vectors=reduced_vec_len, mmap=mmap_vectors)
+
+    output_fpath = os.path.join(output_path, os.path.basename(data_fpath) + ".sweep.tsv")
+    sweep.sweep(output_fpath=output_fpath, graph=graph, relations_fpath=relations_fpath, data_fpath=data_fpath,
+                vector_space=vector_space, eval_data_fpath=eval_data_fpath, data_type=data_type,
+                mapping_fpath=mapping_fpath, Ns=Ns, Ms=Ms, weights=weights, rankings=rankings,
+                weight_function=weight_function, representation_function=representation_function,
+                include_same_relations=include_same_relations, prefetch_batch_size=prefetch_batch_size,
+                n_resamples=n_resamples, confidence=confidence, seed=seed)
+
+    if gek_cache_size > 0:
+        graph.log_stats()
+        graph.save()
+    graph.close()
 
 
 def main():
@@ -206,6 +340,10 @@ def main():
     parser_pipelineExtraction.add_argument("--word-thresh", type=int, default=500)
     parser_pipelineExtraction.add_argument("--event-thresh", type=int, default=50)
     parser_pipelineExtraction.add_argument("--lemmas-freqs-filepath")
+    parser_pipelineExtraction.add_argument("--max-event-size", type=int, default=0,
+                                           help="maximum number of words in an event, 0 for no limit")
+    parser_pipelineExtraction.add_argument("--head-in-events", action="store_true",
+                                           help="only count events including the head")
 
     parser_pipelineExtraction.add_argument('-s', action='store_true', help='flag to launch lemmas freqs extraction')
     parser_pipelineExtraction.add_argument('-e', action='store_true', help='flag to launch events freqs extraction')
@@ -225,12 +363,43 @@ def main():
     parser_sequentExtraction.add_argument("--delimiter", default=" ")
     parser_sequentExtraction.add_argument("--labels", required=True,
                                            help="path to file for filtering pos/roles")
-    parser_sequentExtraction.add_argument("--batch-size-input", type=int, default=1000)
-    parser_sequentExtraction.add_argument("--batch-size-merge", type=int, default=1024)
+    parser_sequentExtraction.add_argument("--batch-size-input", type=int, default=1000,
+                                          help="maximum number of sentences read into a batch by each worker")
+    parser_sequentExtraction.add_argument("--max-batch-tokens", type=int, default=0,
+                                          help="maximum number of tokens read into a batch by each worker, "
+                                               "0 for no limit")
+    parser_sequentExtraction.add_argument("--batch-size-merge", type=int, default=1024,
+                                          help="maximum number of files merged at once")
     # parser_sequentExtraction.add_argument("--batch-size-stats", type=int, default=5000)
     # parser_sequentExtraction.add_argument("--batch-size-events", type=int, default=1000)
     parser_sequentExtraction.add_argument("--word-thresh", type=int, default=500)
     parser_sequentExtraction.add_argument("--event-thresh", type=int, default=50)
+    parser_sequentExtraction.add_argument("--max-event-size", type=int, default=0,
+                                          help="maximum number of words in an event, 0 for no limit")
+    parser_sequentExtraction.add_argument("--head-in-events", action="store_true",
+                                          help="only count events including the head")
+    parser_sequentExtraction.add_argument("--max-events-in-memory", type=int, default=5000000,
+                                          help="number of distinct events each worker counts in memory before "
+                                               "writing them to disk, 0 for no limit")
+    parser_sequentExtraction.add_argument("--partitions", type=int, default=1,
+                                          help="number of hash partitions of the frequencies, merged in parallel "
+                                               "by the workers at the end of the extraction")
+    parser_sequentExtraction.add_argument("--binary-runs", action="store_true",
+                                          help="write intermediate frequencies as binary records, merged without "
+                                               "text parsing. Final frequency files are text in any case")
+    parser_sequentExtraction.add_argument("--prune-error", type=float, default=0,
+                                          help="error bound of lossy event counting, in [0, 1), 0 for exact "
+                                               "counts. Counts of an event in a run no greater than prune-error "
+                                               "times the events of the run are dropped, and statistics are written "
+                                               "to events-freqs.prune.json")
+    parser_sequentExtraction.add_argument("--min-event-freq", type=int, default=0,
+                                          help="events with a lower merged frequency are left out of "
+                                               "events-freqs.gz, 0 to keep them all")
+    parser_sequentExtraction.add_argument("--corpus-cache", action="store_true",
+                                          help="the stats pass writes the parsed dependencies to a binary cache in "
+                                               "the output dir, which the events pass reads instead of the input "
+                                               "files if they and the labels are unchanged. The cache is kept in "
+                                               "corpus-cache/ for later events passes: delete it to free the space")
     parser_sequentExtraction.add_argument("--lemmas-freqs-filepath")
 
     parser_sequentExtraction.add_argument('-s', action='store_true', help='flag to launch lemmas freqs extraction')
@@ -248,6 +417,19 @@ def main():
 
     parser_buildGraph.set_defaults(func=_build_graph)
 
+    # 2b. Precompute the ranked co-arguments of each word, to be sliced when building representations
+    parser_buildIndex = subparsers.add_parser("build-gek-index",
+                                              help="Precompute top-N GEK neighbours for each word and relation pair")
+    parser_buildIndex.add_argument("-g", "--graph-dir", required=True, help="path to folder written by build-graph")
+    parser_buildIndex.add_argument("-r", "--relations", required=True,
+                                   help="path to file containing mapping for relations")
+    parser_buildIndex.add_argument("-o", "--output-dir", required=True, help="path to output dir")
+    parser_buildIndex.add_argument("-N", "--N-from-graph", default=50, type=int,
+                                   help="maximum number of neighbours stored for each query")
+    parser_buildIndex.add_argument("--weights", nargs="+", default=["pmi", "lmi"], choices=["pmi", "lmi"])
+
+    parser_buildIndex.set_defaults(func=_build_gek_index)
+
     # 3. Import database in neo4j
     parser_importGraph = subparsers.add_parser("import-graph", help="Import graph (.csv files) in neo4j")
     parser_importGraph.add_argument("-d","--data", required=True)
@@ -283,21 +465,62 @@ def main():
                                          help="output arguments order")
     parser_prepareInputFile.set_defaults(func=_prepare_input)
 
-    parser_build = subparsers.add_parser("build-representations",
+    parser_convert = subparsers.add_parser("convert-vectors",
+                                           help="convert text vectors to .npy + .vocab files, to be loaded in bulk")
+    parser_convert.add_argument("-v", "--vectors", required=True, help="path to file containing text vectors")
+    parser_convert.add_argument("-o", "--output", required=True, help="path to output .npy file")
+    parser_convert.add_argument("--lemmas-freqs-filepath",
+                                help="path to lemma frequencies file, only lemmas above --word-thresh are kept")
+    parser_convert.add_argument("--word-thresh", type=int, default=0)
+    parser_convert.add_argument("--vectors_with_PoS", action="store_true")
+    parser_convert.add_argument("--reduced-vec-len", type=int, default=-1)
+    parser_convert.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+
+    parser_convert.set_defaults(func=_convert_vectors)
+
+    # arguments shared by the commands building representations
+    parser_model = argparse.ArgumentParser(add_help=False)
+    parser_model.add_argument("-U", "--uri", help="uri to connect to the graph")
+    parser_model.add_argument("-u", "--user", help="user to connect to the graph")
+    parser_model.add_argument("-p", "--password", help="password to connect to the graph")
+    parser_model.add_argument("-G", "--graph-dir",
+                              help="path to folder containing the .csv files written by build-graph, "
+                                   "to query the graph in memory instead of connecting to --uri")
+    parser_model.add_argument("--gek-index",
+                              help="path to folder written by build-gek-index, to be used instead of the graph")
+    parser_model.add_argument("--gek-cache-size", type=int, default=1000000,
+                              help="maximum number of neighbours kept in the GEK cache, 0 disables caching")
+    parser_model.add_argument("--gek-cache-file",
+                              help="path to file where the GEK cache is loaded from and saved to, "
+                                   "to reuse graph results across runs")
+    parser_model.add_argument("--prefetch-batch-size", type=int, default=0,
+                              help="query the graph for all the words of each dataset file before processing it, "
+                                   "sending this many queries per round trip (0 disables prefetching)")
+    parser_model.add_argument("--async-queries", type=int, default=0,
+                              help="number of queries kept in flight at once with the asyncio neo4j driver "
+                                   "(neo4j>=5) while prefetching each dataset file, 0 uses the blocking driver")
+    parser_model.add_argument("-r", "--relations", required=True,
+                              help="path to file containing mapping for relations")
+    parser_model.add_argument("-v", "--vectors", required=True,
+                              help="path to file containing vectors")
+    parser_model.add_argument("--weight-function", default="cosine", choices=["cosine"],
+                              help="function used to rank weighted list against representation vector")
+    parser_model.add_argument("--representation-function", default="centroid", choices=["centroid"],
+                              help="function used to build representation vector")
+    parser_model.add_argument("--include-same-relations", action="store_true")
+    parser_model.add_argument("--reduced-vec-len", type=int, default=-1)
+    parser_model.add_argument("--vectors_with_PoS", action="store_true")
+    parser_model.add_argument("--mmap-vectors", action="store_true",
+                              help="memory-map .npy vectors instead of loading them")
+
+    parser_build = subparsers.add_parser("build-representations", parents=[parser_model],
                                          help="build representations over input files")
     parser_build.add_argument("-o", "--output-dir",
                               help="path to output dir, default is data/results/")
-    parser_build.add_argument("-U", "--uri", help="uri to connect to the graph")
-    parser_build.add_argument("-u", "--user", help="user to connect to the graph")
-    parser_build.add_argument("-p", "--password", help="password to connect to the graph")
-    parser_build.add_argument("-r", "--relations", required=True,
-                              help="path to file containing mapping for relations")
+    parser_build.add_argument("--workers", type=int, default=1,
+                              help="number of processes among which dataset items are spread")
     parser_build.add_argument("-d", "--data", nargs="+", required=True,
                               help="paths to files containing dataset")
-    parser_build.add_argument("-v", "--vectors", required=True,
-                              help="path to file containing vectors")
-    parser_build.add_argument("--weight-function", default="cosine", choices=["cosine"],
-                              help="function used to rank weighted list against representation vector")
     parser_build.add_argument("--not-rank-forward", action="store_false")
     parser_build.add_argument("--not-rank-backward", action="store_false")
     parser_build.add_argument("-N", "--N-from-graph", default=50, type=int,
@@ -305,12 +528,13 @@ def main():
     parser_build.add_argument("-M", "--M-build-rep", default=20, type=int,
                               help="number of elements to be considered to build representation "
                                    "(head of the weighted lists)")
-    parser_build.add_argument("--representation-function", default="centroid", choices=["centroid"],
-                              help="function used to build representation vector")
-    parser_build.add_argument("--include-same-relations", action="store_true")
     parser_build.add_argument("--weight-from-graph", default="pmi", choices=["pmi", "lmi"])
-    parser_build.add_argument("--reduced-vec-len", type=int, default=-1)
-    parser_build.add_argument("--vectors_with_PoS", action="store_true")
+    parser_build.add_argument("--trace", default="off", choices=["off", "summary", "full"],
+                              help="write a step-by-step trace of each dataset file as JSON lines: "
+                                   "summary traces each item and word, full also dumps GEK, LC and AC")
+    parser_build.add_argument("--binary-output", action="store_true",
+                              help="also write LC and AC vectors as .npy matrices next to each output file, "
+                                   "which compute-evaluation reads instead of the text vectors")
 
     parser_build.set_defaults(func=_build_representations)
 
@@ -325,10 +549,40 @@ def main():
 
     parser_eval.set_defaults(func=_compute_evaluation)
 
+    parser_sweep = subparsers.add_parser("sweep", parents=[parser_model],
+                                         help="build and evaluate representations of a dataset "
+                                              "over a grid of settings")
+    parser_sweep.add_argument("-o", "--output-dir", help="path to output dir, default is data/results/")
+    parser_sweep.add_argument("-d", "--data", required=True, help="path to file containing dataset")
+    parser_sweep.add_argument("-e", "--eval-data", required=True, help="path to original dataset")
+    parser_sweep.add_argument("-t", "--type", required=True, choices=["ks", "dtfit"], help="dataset type")
+    parser_sweep.add_argument("-m", "--map", help="path to mapping file, required with -t ks")
+    parser_sweep.add_argument("-N", "--N-from-graph", nargs="+", default=[50], type=int,
+                              help="numbers of elements to be retrieved from graph for each query")
+    parser_sweep.add_argument("-M", "--M-build-rep", nargs="+", default=[20], type=int,
+                              help="numbers of elements to be considered to build representation")
+    parser_sweep.add_argument("--weight-from-graph", nargs="+", default=["pmi"], choices=["pmi", "lmi"])
+    parser_sweep.add_argument("--ranking", nargs="+", default=["both"], choices=["both", "forward", "backward", "none"],
+                              help="directions in which weighted lists are re-ranked")
+    parser_sweep.add_argument("--bootstrap", type=int, default=1000,
+                              help="number of bootstrap resamples for the confidence interval, 0 skips it")
+    parser_sweep.add_argument("--confidence", type=float, default=0.95)
+    parser_sweep.add_argument("--seed", type=int, help="seed of the bootstrap resamples")
+
+    parser_sweep.set_defaults(func=_sweep)
+
     args = parser.parse_args()
     if "func" not in args:
         parser.print_usage()
         exit()
+    if args.func is _sweep and args.type == "ks" and args.map is None:
+        parser_sweep.error("-t ks needs the mapping file given with -m")
+    if args.func is _sequential_extraction and not 0 <= args.prune_error < 1:
+        parser_sequentExtraction.error("--prune-error must be in [0, 1)")
+    if args.func is _sequential_extraction and args.max_event_size < 0:
+        parser_sequentExtraction.error("--max-event-size must not be negative")
+    if args.func is _pipeline_extraction and args.max_event_size < 0:
+        parser_pipelineExtraction.error("--max-event-size must not be negative")
     args.func(args)
 
 
@@ -1,9 +1,16 @@
+import sys
 import copy
+import gzip
+import itertools
+import json
 import logging
+import os
 import string
 import tqdm
 from collections import defaultdict
 
+from sdm.utils import data_utils as dutils
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,75 +25,374 @@ def StanzaReader(text, preprocessing_fn=None, nlp=None):
         yield sentence
 
 
-def CoNLLReader(delimiter, filepaths):
+class Token:
     """
-
-    :param str delimiter: character that separates CONLL file's columns (" " or "\t")
-    :param str filepath: path to input CONLL file
-    :return: a sentence in the form of a list of dictionaries, each dictionary is a token with the following keys: 'id', 'text', 'lemma', 'upos', 'head', 'deprel'
-    :rtype: list[dict]
+    A token of a CONLL sentence, with all its (head, relation) pairs.
+    Strings are interned, so that each lemma, PoS and relation is stored once however many tokens share it.
     """
+    __slots__ = ("id", "text", "lemma", "upos", "deps")
+
+    def __init__(self, id, text, lemma, upos, deps):
+        self.id = id
+        self.text = text
+        self.lemma = lemma
+        self.upos = upos
+        self.deps = deps
+
+
+class Word:
+    """A word of a sentence kept by DependencyBuilder, with standardized PoS"""
+    __slots__ = ("lemma", "upos")
+
+    def __init__(self, lemma, upos):
+        self.lemma = lemma
+        self.upos = upos
 
-    # print("[CONLL READER] - ", filepath)
-    # logger.info("CONLL READER parsing {}".format(filepath))
+
+def _conll_sentences(delimiter, filepath):
+    """
+    :return: sentences of a CONLL file, in the form of lists of Token, skipping ill formed ones
+    """
 
     accepted_chars = string.ascii_letters + "01234567890.-'"
-    BASIC_FIELD_TO_IDX = {'id', 'text', 'lemma', 'upos', 'head', 'deprel'}
+
+    with open(filepath) as fin:
+        sentence = []
+        skip_sentence = False
+
+        for line in fin:
+            line = line.strip()
+
+            if not len(line):
+                if len(sentence):
+                    if not skip_sentence:
+                        yield sentence
+                    sentence = []
+                    skip_sentence = False
+            else:
+                linesplit = line.split(delimiter)
+
+                id, text, lemma, upos, ne, deprels = linesplit
+                deprels = deprels.split(",")
+
+                if any(c in string.ascii_letters for c in lemma) and all(c in accepted_chars for c in lemma):
+
+                    if upos in ["NNP", "NNPS"] and not ne == "O":
+                        text = ne
+                        lemma = ne
+                    else:
+                        lemma = lemma.lower()
+
+                    deps = []
+                    for head_plus_rel in deprels:
+                        try:
+                            rel_label, head = head_plus_rel.rsplit("=", 1)
+                            #head = int(head)
+                            deps.append((sys.intern(head), sys.intern(rel_label)))
+                        except:
+                            skip_sentence = True
+                            logger.info("ILL FORMED LINE:{} (in {})".format(line,filepath))
+
+                    sentence.append(Token(sys.intern(id), text, sys.intern(lemma), sys.intern(upos), tuple(deps)))
+
+        if len(sentence):
+            if not skip_sentence:
+                yield sentence
+
+
+def _batches(sentences_by_file, batch_size, max_tokens, n_tokens=len):
+    """
+    :param sentences_by_file: (filepath, sentences) pairs
+    :return: batches of sentences, read across files, of at most batch_size sentences and max_tokens tokens
+    """
 
     current_batch = []
+    current_tokens = 0
 
-    for filepath in filepaths:
-        with open(filepath) as fin:
-            sentence = []
-            skip_sentence = False
-
-            for line in fin:
-            # for line in tqdm.tqdm(fin, desc="CoNLLReader"):
-                line = line.strip()
-
-                if not len(line):
-                    if len(sentence):
-                        if not skip_sentence:
-                            current_batch.append (sentence)
-                            # if len(current_batch) >= batch_size:
-                            #     yield current_batch
-                            #     current_batch = []
-                        sentence = []
-                        skip_sentence = False
-                else:
-                    linesplit = line.split(delimiter)
-
-                    id, text, lemma, upos, ne, deprels = linesplit
-                    deprels = deprels.split(",")
-
-                    if any(c in string.ascii_letters for c in lemma) and all(c in accepted_chars for c in lemma):
-
-                        if upos in ["NNP", "NNPS"] and not ne == "O":
-                            text = ne
-                            lemma = ne
-                        else:
-                            lemma = lemma.lower()
-
-                        for head_plus_rel in deprels:
-                            try:
-                                rel_label, head = head_plus_rel.rsplit("=", 1)
-                                #head = int(head)
-
-                                token_dict = {'id': id, 'text': text, 'lemma': lemma,
-                                              'upos': upos, 'head': head, 'deprel': rel_label}
-                                sentence.append(token_dict)
-                            except:
-                                skip_sentence = True
-                                logger.info("ILL FORMED LINE:{} (in {})".format(line,filepath))
-
-            if len(sentence):
-               if not skip_sentence:
-                   current_batch.append(sentence)
+    for filepath, sentences in sentences_by_file:
+        for sentence in sentences:
+            current_batch.append(sentence)
+            current_tokens += n_tokens(sentence)
+
+            if (batch_size and len(current_batch) >= batch_size) or (max_tokens and current_tokens >= max_tokens):
+                yield current_batch
+                current_batch = []
+                current_tokens = 0
+
+        logger.info("Finish reading: {}".format(filepath))
 
     if len(current_batch):
         yield current_batch
 
-    logger.info("Finish reading: {}".format(filepath))
+
+def CoNLLReader(delimiter, filepaths, batch_size=0, max_tokens=0):
+    """
+
+    :param str delimiter: character that separates CONLL file's columns (" " or "\t")
+    :param list filepaths: paths to input CONLL files
+    :param int batch_size: maximum number of sentences in a batch, 0 for no limit
+    :param int max_tokens: maximum number of tokens in a batch, 0 for no limit
+    :return: batches of sentences, read across files. Each sentence is in the form of a list of Token
+    :rtype: list[list[Token]]
+    """
+
+    yield from _batches(((filepath, _conll_sentences(delimiter, filepath)) for filepath in filepaths),
+                        batch_size, max_tokens)
+
+
+def _events_sentences(delimiter, accepted_pos, accepted_rel, accepted_lemmas, filepath):
+    """
+    :return: sentences of a CONLL file as DependencyBuilder gives them, restricted to what extract_patterns uses:
+             dependencies with accepted relation, between words with accepted PoS, whose dependent is an accepted
+             lemma. Sentences left without dependencies are skipped.
+    """
+
+    accepted_chars = string.ascii_letters + "01234567890.-'"
+
+    with open(filepath) as fin:
+        words = {}  # {token_id: (lemma, pos)} of tokens with accepted PoS
+        deps = []  # (dep_id, head_id, role) with accepted role
+        skip_sentence = False
+
+        # a blank line is appended to close the last sentence
+        for line in itertools.chain(fin, [""]):
+            line = line.strip()
+
+            if not len(line):
+                if len(deps) and not skip_sentence:
+                    sentence = _events_sentence(words, deps, accepted_lemmas)
+                    if sentence is not None:
+                        yield sentence
+                words = {}
+                deps = []
+                skip_sentence = False
+                continue
+
+            if skip_sentence:
+                continue
+
+            id, text, lemma, upos, ne, deprels = line.split(delimiter)
+
+            if not (any(c in string.ascii_letters for c in lemma) and all(c in accepted_chars for c in lemma)):
+                continue
+
+            deprels = deprels.split(",")
+            if not all("=" in head_plus_rel for head_plus_rel in deprels):
+                skip_sentence = True
+                logger.info("ILL FORMED LINE:{} (in {})".format(line, filepath))
+                continue
+
+            pos = _pos_standardization(upos)
+            if pos not in accepted_pos:
+                continue
+
+            if upos in ["NNP", "NNPS"] and not ne == "O":
+                lemma = ne
+            else:
+                lemma = lemma.lower()
+            if lemma in PRONOUNS:
+                lemma, pos = "PERSON", "N"
+
+            if id not in words:
+                words[id] = (sys.intern(lemma), sys.intern(pos))
+
+            for head_plus_rel in deprels:
+                rel_label, head = head_plus_rel.rsplit("=", 1)
+                role = _relation_standardization(rel_label)
+                if role.startswith(accepted_rel):
+                    deps.append((id, head, sys.intern(role)))
+
+
+def _events_sentence(words, deps, accepted_lemmas):
+    dependencies = defaultdict(list)
+    for dep_id, head, role in deps:
+        if head in words and (not len(accepted_lemmas) or words[dep_id] in accepted_lemmas):
+            dependencies[head].append((dep_id, role))
+
+    if not len(dependencies):
+        return None
+
+    words_dict = {}
+    for head, head_deps in dependencies.items():
+        words_dict[head] = Word(*words[head])
+        for dep_id, _ in head_deps:
+            words_dict[dep_id] = Word(*words[dep_id])
+
+    return words_dict, dependencies
+
+
+def EventsReader(delimiter, accepted_pos, accepted_rel, accepted_lemmas, filepaths, batch_size=0, max_tokens=0):
+    """
+    CoNLLReader and DependencyBuilder fused for events extraction: PoS, relation and lemma filters are applied while
+    parsing lines, so that rejected tokens are never stored.
+
+    :param str delimiter: character that separates CONLL file's columns (" " or "\t")
+    :param list accepted_pos: filter out lemmas with pos out of this list
+    :param list accepted_rel: filter out relations out of that list
+    :param set accepted_lemmas: (lemma, pos) tuples that can be members of events, empty to accept all
+    :param list filepaths: paths to input CONLL files
+    :param int batch_size: maximum number of sentences in a batch, 0 for no limit
+    :param int max_tokens: maximum number of words in a batch, 0 for no limit
+    :return: batches of (words dictionary {token_id : Word}, dependencies dictionary {head_id:[(dep_id, role)]})
+    """
+
+    accepted_rel = tuple(accepted_rel)
+
+    yield from _batches(((filepath, _events_sentences(delimiter, accepted_pos, accepted_rel, accepted_lemmas,
+                                                      filepath))
+                         for filepath in filepaths),
+                        batch_size, max_tokens, n_tokens=lambda sentence: len(sentence[0]))
+
+
+class CorpusCacheWriter:
+    """
+    Binary cache of the sentences given by DependencyBuilder, restricted to the words in dependencies, to be read by
+    CacheReader instead of parsing the CONLL files again.
+    Each sentence is a length-prefixed record of varints: the number of words, lemma and PoS of each word, the number
+    of dependencies and (dependent, head, relation) of each, with words as positions in the sentence. Strings are
+    numbered from 1 in order of appearance in the file, and 0 introduces a new string, followed by its length and its
+    UTF-8 bytes.
+    """
+
+    def __init__(self, filepath):
+        self.fout = gzip.open(filepath, "wb", compresslevel=1)
+        self.strings = {}
+        self.buffer = bytearray()
+
+    def _string(self, record, text):
+        sid = self.strings.get(text)
+        if sid is None:
+            self.strings[text] = len(self.strings) + 1
+            encoded = text.encode("utf-8")
+            record += b"\x00"
+            record += dutils.varint(len(encoded))
+            record += encoded
+        else:
+            record += dutils.varint(sid)
+
+    def write(self, words, dependencies):
+        """
+        :param dict words: words dictionary {token_id : Word}
+        :param dict dependencies: dependencies dictionary {head_id:[(dep_id, role)]}
+        """
+        if not len(dependencies):
+            return
+
+        positions = {}
+        for head, head_deps in dependencies.items():
+            positions.setdefault(head, len(positions))
+            for dep_id, _ in head_deps:
+                positions.setdefault(dep_id, len(positions))
+
+        record = bytearray(dutils.varint(len(positions)))
+        for token_id in positions:
+            self._string(record, words[token_id].lemma)
+            self._string(record, words[token_id].upos)
+
+        record += dutils.varint(sum(len(head_deps) for head_deps in dependencies.values()))
+        for head, head_deps in dependencies.items():
+            for dep_id, role in head_deps:
+                record += dutils.varint(positions[dep_id])
+                record += dutils.varint(positions[head])
+                self._string(record, role)
+
+        self.buffer += dutils.varint(len(record))
+        self.buffer += record
+        if len(self.buffer) > 1 << 20:
+            self.fout.write(self.buffer)
+            self.buffer.clear()
+
+    def close(self):
+        self.fout.write(self.buffer)
+        self.fout.close()
+
+
+def _cache_sentences(accepted_lemmas, filepath):
+    """
+    :return: sentences of a file written by CorpusCacheWriter, as EventsReader gives them
+    """
+    strings = [None]
+
+    def read_string(data, pos):
+        sid, pos = dutils.decode_varint(data, pos)
+        if sid:
+            return strings[sid], pos
+        length, pos = dutils.decode_varint(data, pos)
+        strings.append(sys.intern(data[pos:pos + length].decode("utf-8")))
+        return strings[-1], pos + length
+
+    with gzip.open(filepath, "rb") as fin:
+        while True:
+            length = dutils.read_varint(fin)
+            if length is None:
+                break
+            data = fin.read(length)
+
+            n_words, pos = dutils.decode_varint(data, 0)
+            words = {}
+            for i in range(n_words):
+                lemma, pos = read_string(data, pos)
+                upos, pos = read_string(data, pos)
+                words[i] = (lemma, upos)
+
+            n_deps, pos = dutils.decode_varint(data, pos)
+            deps = []
+            for _ in range(n_deps):
+                dep_id, pos = dutils.decode_varint(data, pos)
+                head, pos = dutils.decode_varint(data, pos)
+                role, pos = read_string(data, pos)
+                deps.append((dep_id, head, role))
+
+            sentence = _events_sentence(words, deps, accepted_lemmas)
+            if sentence is not None:
+                yield sentence
+
+
+def CacheReader(accepted_lemmas, filepaths, batch_size=0, max_tokens=0):
+    """
+    EventsReader over the files of a corpus cache written by the stats pass, which already applied PoS and relation
+    filters.
+
+    :param set accepted_lemmas: (lemma, pos) tuples that can be members of events, empty to accept all
+    :param list filepaths: paths to files written by CorpusCacheWriter
+    :param int batch_size: maximum number of sentences in a batch, 0 for no limit
+    :param int max_tokens: maximum number of words in a batch, 0 for no limit
+    :return: batches of (words dictionary {position : Word}, dependencies dictionary {head:[(dep, role)]})
+    """
+
+    yield from _batches(((filepath, _cache_sentences(accepted_lemmas, filepath)) for filepath in filepaths),
+                        batch_size, max_tokens, n_tokens=lambda sentence: len(sentence[0]))
+
+
+CACHE_MANIFEST = "manifest.json"
+
+
+def cache_manifest(input_fnames, accepted_pos, accepted_rels, delimiter):
+    """
+    :return: description of what a corpus cache is built from: input files with their size and modification time,
+             accepted labels and delimiter
+    """
+    files = []
+    for fname in sorted(input_fnames):
+        stat = os.stat(fname)
+        files.append([os.path.abspath(fname), stat.st_size, stat.st_mtime_ns])
+    return {"files": files, "pos": list(accepted_pos), "relations": list(accepted_rels), "delimiter": delimiter}
+
+
+def write_cache_manifest(cache_dir, input_fnames, accepted_pos, accepted_rels, delimiter):
+    with open(cache_dir + CACHE_MANIFEST, "w") as fout:
+        json.dump(cache_manifest(input_fnames, accepted_pos, accepted_rels, delimiter), fout)
+
+
+def read_cache_manifest(cache_dir):
+    """
+    :return: the manifest of the corpus cache in cache_dir, None if it has none
+    """
+    try:
+        with open(cache_dir + CACHE_MANIFEST) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return None
 
 
 def ukWaCReader(filepath):
@@ -106,38 +412,44 @@ def ukWaCReader(filepath):
         if len(sentence):
             yield sentence
 
+def _relation_standardization(role):
+    if role == "nsubjpass":
+        role = "dobj"
+    elif role == "csubjpass":
+        role = "ccomp"
+    elif role == "nsubj:xsubj":
+        role = "nsubj"
+    elif role == "nmod:agent":
+        role = "nsubj"
+    return role
+
+
+def _pos_standardization(pos):
+    if pos.startswith("V"):
+        pos = "V"
+    elif pos.startswith("N"):
+        pos = "N"
+    elif pos.startswith("J"):
+        pos = "J"
+    return pos
+
+
+# personal pronouns, refined to PERSON
+PRONOUNS = ["I", "he", "she", "you", "we", "they"]
+
+
 def DependencyBuilder(accepted_pos, accepted_rel, sentences, refine=True):
     """
     :param list accepted_pos: filter out lemmas with pos out of this list
     :param list accepted_rel: filter out relations out of that list
-    :param list sentence: a list of dictionaries, each dictionary represent a tokens with the following keys: 'id', 'text', 'lemma', 'upos', 'head', 'deprel'
+    :param list sentence: a list of Token
     :param boolean refine: a flag that indicates if applying morpho-syntactic refinements or not
     :returns:
-            -words_dict (:py:class:`dict`) - a words dictionary {token_id : {lemma,upos}}
+            -words_dict (:py:class:`dict`) - a words dictionary {token_id : Word}
             -deps_ids_dict_copy () - a dependencies dictionary {head_id:[(dep_id, role)]}
 
     """
     # logger.info("Processing sentence: {}".format(sentence))
-    def relation_standardization(role):
-        if role == "nsubjpass":
-            role = "dobj"
-        elif role == "csubjpass":
-            role = "ccomp"
-        elif role == "nsubj:xsubj":
-            role = "nsubj"
-        elif role == "nmod:agent":
-            role = "nsubj"
-        return role
-
-    def pos_standardization(pos):
-        if pos.startswith("V"):
-            pos = "V"
-        elif pos.startswith("N"):
-            pos = "N"
-        elif pos.startswith("J"):
-            pos = "J"
-        return pos
-
     def refine_lemmas(w_dict, deps_dict):
         # refine lemmas
         for head_id in deps_dict:
@@ -145,36 +457,36 @@ def DependencyBuilder(accepted_pos, accepted_rel, sentences, refine=True):
                 # 1: phrasal verbs
                 if "prt" in dep_tup[1]:
                     try:
-                        if w_dict[dep_tup[0]]["upos"] == "RP" and w_dict[head_id]["upos"] == "VERB":
-                            w_dict[head_id]["lemma"] = "{}_{}".format(w_dict[head_id]["lemma"],
-                                                                      w_dict[dep_tup[0]]["lemma"])
+                        if w_dict[dep_tup[0]].upos == "RP" and w_dict[head_id].upos == "VERB":
+                            w_dict[head_id].lemma = "{}_{}".format(w_dict[head_id].lemma, w_dict[dep_tup[0]].lemma)
                     except KeyError:
                         pass
         # 2: personal pronouns
         for w_id in w_dict.keys():
             word = w_dict[w_id]
-            if word["lemma"] in ["I", "he", "she", "you", "we", "they"]:
-                word["lemma"] = "PERSON"
-                word["upos"] = "N"
+            if word.lemma in PRONOUNS:
+                word.lemma = "PERSON"
+                word.upos = "N"
 
     accepted_rel = tuple(accepted_rel)
     current_batch = []
 
     for sentence in sentences:
         # read input sentence
-        words_dict = {} # {token_id : {lemma,upos}}
+        words_dict = {} # {token_id : Word}
         deps_ids_dict = defaultdict(list) # {head_id:[(dep_id, role)]}
         for token in sentence:
-            pos = pos_standardization(token["upos"])
+            pos = _pos_standardization(token.upos)
             # take only words with a given PoS
             if pos in accepted_pos:
-                deps_ids_dict[token["head"]].append((token["id"], relation_standardization(token["deprel"])))
+                for head, deprel in token.deps:
+                    deps_ids_dict[head].append((token.id, _relation_standardization(deprel)))
                 # take only dependencies with a given label
                 # role = relation_standardization(token["deprel"])
                 # if role.startswith(tuple(accepted_rel)):
                 #     deps_ids_dict[token["head"]].append((token["id"], role))
-                if token["id"] not in words_dict:
-                    words_dict[token["id"]] = {'lemma': token["lemma"], 'upos': pos}
+                if token.id not in words_dict:
+                    words_dict[token.id] = Word(token.lemma, pos)
 
         if refine: refine_lemmas(words_dict, deps_ids_dict)
 
@@ -1,3 +1,8 @@
+import os
+import zlib
+import uuid
+import heapq
+import operator
 import numpy as np
 import logging
 import itertools
@@ -26,6 +31,54 @@ def dump_results(fpath, res, out_fpath):
             print(line+"\t{}\t{}".format(v1, v2), file=fout)
 
 
+def results_matrices(res):
+    """
+    :return: LC and AC vectors of each item as two matrices, one row per item, where vectors that are None are rows of
+             NaN, and an (items x 2) boolean matrix marking which of them are not None
+    """
+    dim = next((len(v) for item in res for v in item if v is not None), 0)
+
+    mask = np.array([[v is not None for v in item] for item in res], dtype=bool).reshape(len(res), 2)
+
+    matrices = []
+    for j in range(2):
+        matrix = np.full((len(res), dim), np.nan, dtype=np.float32)
+        for i, item in enumerate(res):
+            if item[j] is not None:
+                matrix[i] = item[j]
+        matrices.append(matrix)
+
+    return matrices[0], matrices[1], mask
+
+
+def dump_results_binary(res, out_fpath):
+    """
+    Write the matrices of results_matrices to out_fpath.LC.npy, out_fpath.AC.npy and out_fpath.mask.npy
+    """
+    LC, AC, mask = results_matrices(res)
+    np.save(out_fpath+".LC.npy", LC)
+    np.save(out_fpath+".AC.npy", AC)
+    np.save(out_fpath+".mask.npy", mask)
+
+
+def load_results_binary(out_fpath):
+    """
+    :return: LC matrix, AC matrix and mask written by dump_results_binary next to out_fpath, memory-mapped,
+             or None if they were not written or are older than out_fpath
+    """
+    fpaths = [out_fpath+ext for ext in (".LC.npy", ".AC.npy", ".mask.npy")]
+    if not all(os.path.exists(fpath) for fpath in fpaths):
+        return None
+
+    # dump_results_binary runs after the text output is written, so older matrices come from a previous run
+    if os.path.exists(out_fpath) and min(os.path.getmtime(fpath) for fpath in fpaths) < os.path.getmtime(out_fpath):
+        logger.warning("ignoring .npy results older than {}".format(out_fpath))
+        return None
+
+    return (np.load(out_fpath+".LC.npy", mmap_mode="r"), np.load(out_fpath+".AC.npy", mmap_mode="r"),
+            np.load(out_fpath+".mask.npy", mmap_mode="r"))
+
+
 def load_dataset(fpath):
     dataset = []
     with open(fpath) as fin:
@@ -86,6 +139,40 @@ class VectorsDict(dict):
         return super().__getitem__(form)
 
 
+class MmapVectors:
+    """
+    Vectors memory-mapped from a .npy file (and its .vocab file), with an index from words to rows.
+    Nothing is read from the matrix until a vector is requested, rows are returned as views and
+    processes sharing the file share its pages.
+    """
+
+    def __init__(self, vectors_fpath, withPoS=False, noun_set=set(), len_vectors=-1):
+        self.withPoS = withPoS
+
+        self.matrix = np.load(vectors_fpath, mmap_mode="r")
+        if len_vectors > -1:
+            self.matrix = self.matrix[:, :len_vectors]
+
+        vocab = _load_vocab(vectors_fpath[:-4]+".vocab")
+        self.index = {key: i for i, key in enumerate(vocab) if key in noun_set or not len(noun_set)}
+
+        logger.info("mapped {} vectors".format(len(self.index)))
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, item):
+
+        form, pos = item
+        if self.withPoS:
+            form = form+"/"+pos
+
+        return self.matrix[self.index[form]]
+
+
 def _load_vocab(fpath):
     ret = []
     with open(fpath) as fin:
@@ -144,15 +231,74 @@ def _load_vectors_from_text(vectors_fpath, withPoS, noun_set, len_vectors):
     return noun_vectors
 
 
-def load_vectors(vectors_fpath, withPoS=False, noun_set=set(), len_vectors=-1):
+def load_vectors(vectors_fpath, withPoS=False, noun_set=set(), len_vectors=-1, mmap=False):
+
+    if mmap and not vectors_fpath.endswith(".npy"):
+        logger.warning("only .npy vector files can be memory-mapped, {} is loaded in memory: "
+                       "convert it first with convert-vectors".format(vectors_fpath))
 
-    if vectors_fpath.endswith(".npy"):
+    if vectors_fpath.endswith(".npy") and mmap:
+        ret = MmapVectors(vectors_fpath, withPoS=withPoS, noun_set=noun_set, len_vectors=len_vectors)
+    elif vectors_fpath.endswith(".npy"):
         ret = _load_vectors_npy(vectors_fpath, withPoS=withPoS, noun_set=noun_set, len_vectors=len_vectors)
     else:
         ret = _load_vectors_from_text(vectors_fpath, withPoS=withPoS, noun_set=noun_set, len_vectors=len_vectors)
     return ret
 
 
+def convert_vectors(vectors_fpath, output_fpath, lemmas_freqs_fpath=None, thresh=0, withPoS=False,
+                    len_vectors=-1, dtype="float32"):
+    """
+    Convert word2vec-style text vectors into a .npy matrix and a .vocab file (one word per line),
+    the format read by _load_vectors_npy and MmapVectors.
+
+    :param str lemmas_freqs_fpath: if given, only keep lemmas with frequency above thresh in this file
+    :param bool withPoS: whether vectors are labelled as lemma/pos, as in the lemma frequencies file
+    :param int len_vectors: if > -1, only keep the last len_vectors dimensions, as _load_vectors_from_text does
+    :param str dtype: float32 or float16
+    :raises ValueError: if the file has more vectors than declared in its header
+    """
+
+    noun_set = set()
+    if lemmas_freqs_fpath is not None:
+        for lemma, pos in load_lemmapos_freqs(lemmas_freqs_fpath, thresh):
+            noun_set.add(lemma+"/"+pos if withPoS else lemma)
+
+    with open(vectors_fpath) as fin_model:
+        n_words, len_from_file = fin_model.readline().strip().split()
+        len_from_file = int(len_from_file)
+        if len_vectors == -1:
+            len_vectors = len_from_file
+
+        vectors = np.empty((int(n_words), len_vectors), dtype=dtype)
+        vocab = []
+
+        for line in fin_model:
+            line = line.strip().split()
+            len_line = len(line)
+            word = " ".join(line[:len_line-len_from_file])
+
+            if " " in word:
+                # vocab files are whitespace separated
+                logger.info("skipping multi-word entry {}".format(word))
+            elif word in noun_set or not len(noun_set):
+                if len(vocab) == len(vectors):
+                    raise ValueError("{} has more vectors than the {} declared in its header".format(vectors_fpath,
+                                                                                                     n_words))
+                try:
+                    vectors[len(vocab)] = np.array(line[-len_vectors:], dtype=dtype)
+                    vocab.append(word)
+                except ValueError:
+                    logger.info("problem with vector for word {}".format(word))
+
+    np.save(output_fpath, vectors[:len(vocab)])
+    with open(output_fpath[:-4]+".vocab", "w") as fout:
+        for word in vocab:
+            print(word, file=fout)
+
+    logger.info("converted {} vectors".format(len(vocab)))
+
+
 def load_set(filepath):
     ret = set()
     with open(filepath) as fin:
@@ -162,10 +308,22 @@ def load_set(filepath):
     return ret
 
 
+def open_freqs(filepath):
+    """
+    :return: text file object over a frequency file, gzipped or not
+    """
+    with open(filepath, "rb") as fin:
+        gzipped = fin.read(2) == b"\x1f\x8b"
+
+    if gzipped:
+        return gzip.open(filepath, "rt")
+    return open(filepath)
+
+
 def load_lemmapos_freqs(filepath, thresh, delimiter="\t"):
     # It returns the vocabulary of the frequency file (WARNING: returning items are space-separated)
     ret = set()
-    with gzip.open(filepath, "rt") as fin:
+    with open_freqs(filepath) as fin:
         for line in fin:
             line = line.strip().split(delimiter)
             lemma, freq = line
@@ -178,7 +336,7 @@ def load_lemmapos_freqs(filepath, thresh, delimiter="\t"):
 def load_freqs(filepath):
     # It returns the tuple (item, freq)
     items = set()
-    with open(filepath) as fin:
+    with open_freqs(filepath) as fin:
         for line in fin:
             item, freq = line.strip().split("\t")
             items.add((item, freq))
@@ -187,7 +345,7 @@ def load_freqs(filepath):
 
 def count_absolute_freq(filepath):
     N = 0.0
-    with open(filepath) as fin:
+    with open_freqs(filepath) as fin:
         for line in fin:
             freq = float(line.strip().split("\t")[1])
             N += freq
@@ -196,7 +354,7 @@ def count_absolute_freq(filepath):
 
 def load_n_events_freq(filepath):
     n_events = defaultdict(int)
-    with open(filepath) as fin:
+    with open_freqs(filepath) as fin:
         for line in fin:
             event, freq = line.strip().split("\t")
             n = len(event.split(" "))
@@ -204,6 +362,314 @@ def load_n_events_freq(filepath):
     #print(n_events)
     return n_events
 
+def partition_of(key, partitions):
+    """
+    :param key: formatted key, str or bytes
+    :return: partition of a key among a number of partitions, stable across processes and runs
+    """
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    return zlib.crc32(key) % partitions
+
+
+def run_partition(fname):
+    """
+    :return: partition of a run written by SpillCounter
+    """
+    return int(fname.rsplit(".p", 1)[1].split(".")[0])
+
+
+def varint(n):
+    """
+    :return: bytes of a non negative integer, 7 bits per byte, least significant first
+    """
+    ret = bytearray()
+    while n > 0x7f:
+        ret.append(n & 0x7f | 0x80)
+        n >>= 7
+    ret.append(n)
+    return bytes(ret)
+
+
+def read_varint(fin):
+    """
+    :return: integer read from a binary file, None at the end of the file
+    """
+    n = shift = 0
+    while True:
+        byte = fin.read(1)
+        if not byte:
+            if shift:
+                raise EOFError("truncated varint")
+            return None
+        n |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            return n
+        shift += 7
+
+
+def decode_varint(data, pos):
+    """
+    :return: integer starting at position pos of data, and the position following it
+    """
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def read_records(fin, chunk_size=1 << 20):
+    """
+    :param fin: binary run, opened in binary mode
+    :return: generator of (key, freq) records, with key as bytes. Records are parsed from chunks of chunk_size bytes
+    """
+    data = b""
+    while True:
+        chunk = fin.read(chunk_size)
+        data += chunk
+        pos = 0
+        end = len(data)
+        try:
+            while pos < end:
+                # lengths and frequencies mostly fit in one byte
+                length = data[pos]
+                if length < 0x80:
+                    key_start = pos + 1
+                else:
+                    length, key_start = decode_varint(data, pos)
+                key_end = key_start + length
+                freq = data[key_end]
+                if freq < 0x80:
+                    next_pos = key_end + 1
+                else:
+                    freq, next_pos = decode_varint(data, key_end)
+                yield data[key_start:key_end], freq
+                pos = next_pos
+        except IndexError:
+            # record continuing in the next chunk
+            if not chunk:
+                raise EOFError("truncated record")
+        data = data[pos:]
+        if not chunk:
+            return
+
+
+class SpillCounter:
+    """
+    Frequencies of keys, written to a new sorted gzipped run whenever more than max_keys keys are held in memory
+    (0 for no limit), so that the runs can be merged afterwards.
+    With more than one partition, keys are spread among partitions by the hash of their formatted string, and each
+    run is made of one file per partition, which can be merged independently of the others.
+    Binary runs are made of length-prefixed records, key bytes followed by the frequency, both as varints, compressed
+    with the fastest level.
+    With a prune error e, counting is lossy: keys counted no more than e times the keys counted in a run are left out
+    of that run, so that merged frequencies are underestimated by at most e times the number of keys counted.
+    """
+
+    def __init__(self, fname_pattern, max_keys=0, format_key=str, partitions=1, binary=False, prune_error=0):
+        """
+        :param str fname_pattern: path of runs, formatted with the number of the run as `run` and the number
+                                  of the partition as `partition`, which should end in .p{partition}.gz
+        :param format_key: function formatting a key as str, or as bytes for binary runs
+        :param float prune_error: error bound of lossy counting, 0 for exact counts
+        """
+        self.fname_pattern = fname_pattern
+        self.max_keys = max_keys
+        self.format_key = format_key
+        self.partitions = partitions
+        self.binary = binary
+        self.prune_error = prune_error
+        self.counts = defaultdict(int)
+        self.runs = []
+        self.n_runs = 0
+        # totals over all runs: keys counted, keys left out of runs and their frequency
+        self.counted = 0
+        self.pruned_keys = 0
+        self.pruned_freq = 0
+
+    def update(self, keys):
+        counts = self.counts
+        for key in keys:
+            counts[key] += 1
+
+        if self.max_keys and len(counts) > self.max_keys:
+            self.spill()
+
+    def spill(self):
+        if len(self.counts):
+            self._write_run()
+
+    def _write_run(self):
+        fnames = [self.fname_pattern.format(run=self.n_runs, partition=partition)
+                  for partition in range(self.partitions)]
+        if self.binary:
+            fouts = [gzip.open(fname, "wb", compresslevel=1) for fname in fnames]
+            buffers = [bytearray() for _ in fnames]
+        else:
+            fouts = [gzip.open(fname, "wt") for fname in fnames]
+
+        counted = sum(self.counts.values())
+        self.counted += counted
+        counts = self.counts.items()
+        if self.prune_error:
+            max_pruned = int(self.prune_error * counted)
+            counts = [(key, freq) for key, freq in counts if freq > max_pruned]
+            self.pruned_keys += len(self.counts) - len(counts)
+            self.pruned_freq += counted - sum(freq for _, freq in counts)
+
+        # runs are sorted by formatted key, which is what merges compare
+        for key, freq in sorted((self.format_key(key), freq) for key, freq in counts):
+            partition = partition_of(key, self.partitions) if self.partitions > 1 else 0
+            if self.binary:
+                buffer = buffers[partition]
+                buffer += varint(len(key))
+                buffer += key
+                buffer += varint(freq)
+                if len(buffer) > 1 << 20:
+                    fouts[partition].write(buffer)
+                    buffer.clear()
+            else:
+                fouts[partition].write("{}\t{}\n".format(key, freq))
+
+        for partition, fout in enumerate(fouts):
+            if self.binary:
+                fout.write(buffers[partition])
+            fout.close()
+
+        self.runs.extend(fnames)
+        self.n_runs += 1
+        self.counts = defaultdict(int)
+
+    def close(self):
+        """
+        :return: paths of all the runs written, at least one
+        """
+        if len(self.counts) or not len(self.runs):
+            self._write_run()
+        return self.runs
+
+
+def merge_sorted_runs(fnames, output_fname, delete_input=True, decode_key=None, min_freq=0, batch_size=0):
+    """
+    Merge frequency files sorted by key into one gzipped frequency file, summing the frequencies of equal keys.
+    Frequencies are written as floats, as collapse does.
+
+    :param decode_key: function turning the bytes of a key into str, if the runs are binary. The output is text in
+                       any case
+    :param int min_freq: keys with a lower merged frequency are not written
+    :param int batch_size: maximum number of files open at once, 0 for no limit. More files are merged in rounds,
+                           through intermediate runs written next to the first of them, binary for binary runs
+    :return: number of keys written and number of keys below min_freq
+    """
+    if batch_size and len(fnames) > batch_size:
+        fnames = _merge_rounds(fnames, delete_input, batch_size, binary=decode_key is not None)
+        delete_input = True
+
+    written = below = 0
+    if decode_key is None:
+        files = [open_freqs(fname) for fname in fnames]
+        runs = [(line.rstrip("\n").split("\t") for line in fin) for fin in files]
+        decode_key = str
+        parse_freq = float
+    else:
+        files = [gzip.open(fname, "rb") for fname in fnames]
+        runs = [read_records(fin) for fin in files]
+        parse_freq = int
+    try:
+        records = heapq.merge(*runs, key=operator.itemgetter(0))
+        with gzip.open(output_fname, "wt") as fout:
+            for key, group in itertools.groupby(records, key=operator.itemgetter(0)):
+                freq = sum(parse_freq(freq) for _, freq in group)
+                if freq < min_freq:
+                    below += 1
+                    continue
+                fout.write("{}\t{}\n".format(decode_key(key), float(freq)))
+                written += 1
+    finally:
+        for fin in files:
+            fin.close()
+
+    if delete_input:
+        for fname in fnames:
+            os.remove(fname)
+
+    return written, below
+
+
+def merge_binary_runs(fnames, output_fname, delete_input=True):
+    """
+    Merge binary runs into one binary run, summing the frequencies of equal keys.
+    """
+    files = [gzip.open(fname, "rb") for fname in fnames]
+    try:
+        records = heapq.merge(*(read_records(fin) for fin in files), key=operator.itemgetter(0))
+        with gzip.open(output_fname, "wb", compresslevel=1) as fout:
+            buffer = bytearray()
+            for key, group in itertools.groupby(records, key=operator.itemgetter(0)):
+                buffer += varint(len(key))
+                buffer += key
+                buffer += varint(sum(freq for _, freq in group))
+                if len(buffer) > 1 << 20:
+                    fout.write(buffer)
+                    buffer.clear()
+            fout.write(buffer)
+    finally:
+        for fin in files:
+            fin.close()
+
+    if delete_input:
+        for fname in fnames:
+            os.remove(fname)
+
+
+def _merge_rounds(fnames, delete_input, batch_size, binary=False):
+    """
+    :return: paths of at most batch_size runs, merged from groups of batch_size runs, round after round
+    """
+    tmp_folder = os.path.dirname(fnames[0])
+    while len(fnames) > batch_size:
+        merged = []
+        for i in range(0, len(fnames), batch_size):
+            run = os.path.join(tmp_folder, "merged-run-{}.gz".format(uuid.uuid4()))
+            if binary:
+                merge_binary_runs(fnames[i:i+batch_size], run, delete_input)
+            else:
+                merge_sorted_runs(fnames[i:i+batch_size], run, delete_input)
+            merged.append(run)
+        logger.info("Merged {} runs into {}".format(len(fnames), len(merged)))
+        fnames = merged
+        delete_input = True
+    return fnames
+
+
+def sort_freqs(fname, output_fname, tmp_folder, max_keys=1000000, batch_size=0):
+    """
+    Sort a frequency file with unique keys by key, through sorted runs of at most max_keys keys, into a gzipped
+    frequency file.
+
+    :param int batch_size: maximum number of runs open at once, 0 for no limit
+    """
+    runs = []
+    with open_freqs(fname) as fin:
+        while True:
+            records = sorted(line.rstrip("\n").split("\t") for line in itertools.islice(fin, max_keys))
+            if not len(records) and len(runs):
+                break
+            run = tmp_folder + "sorted-run-{}.gz".format(len(runs))
+            with gzip.open(run, "wt") as fout:
+                for key, freq in records:
+                    fout.write("{}\t{}\n".format(key, freq))
+            runs.append(run)
+            if len(records) < max_keys:
+                break
+
+    merge_sorted_runs(runs, output_fname, batch_size=batch_size)
+
+
 def grouper(iterable, n, fillvalue=None):
     """Collect data into fixed-length chunks or blocks"
     # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"""
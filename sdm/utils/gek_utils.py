@@ -0,0 +1,615 @@
+"""
+Backends answering GEK queries: the top-K co-arguments of a (form, POS) word, reached through the events in which
+the word plays one of a set of roles while the co-argument plays one of another set of roles.
+Results are lists of (form, POS, weight) tuples, sorted by decreasing weight.
+"""
+
+import os
+import abc
+import csv
+import json
+import pickle
+import asyncio
+import logging
+import collections
+import tqdm
+import numpy as np
+import pandas as pd
+
+from sdm.utils import data_utils as dutils
+from sdm.utils import graph_utils as gutils
+
+logger = logging.getLogger(__name__)
+
+NAMED_ENTITIES = ['LOCATION', 'PERSON', 'ORGANIZATION']
+
+
+def split_roles(roles):
+    """
+    :param list roles: roles as listed in the relations mapping file, where 'None' stands for edges without a role
+    :return: the list of actual roles and a flag telling whether edges without a role are accepted
+    """
+    return [x for x in roles if not x == 'None'], 'None' in roles
+
+
+class GEKBackend(abc.ABC):
+    """Base class of GEK backends, which implement top_k and source."""
+
+    @abc.abstractmethod
+    def top_k(self, form, pos, roles_in, roles_out, K, weight):
+        """
+        :return list: the top-K co-arguments of (form, pos) as (form, POS, weight) tuples, sorted by decreasing weight
+        """
+
+    def top_k_batch(self, requests, K, weight):
+        """
+        :param list requests: (form, pos, roles_in, roles_out) tuples
+        :return list: the results of top_k for each request
+        """
+        return [self.top_k(form, pos, roles_in, roles_out, K, weight) for form, pos, roles_in, roles_out in requests]
+
+    def top_k_batches(self, batches, K, weight):
+        """
+        :param list batches: lists of requests, as taken by top_k_batch
+        :return list: the results of top_k_batch for each batch
+        """
+        return [self.top_k_batch(requests, K, weight) for requests in batches]
+
+    def clone(self):
+        """Backend to be used by a forked worker process. Read-only backends are shared as they are."""
+        return self
+
+    def take_updates(self):
+        """
+        :return: what a clone learnt since the last call, to be merged in the parent process by merge_updates,
+                 None if there is nothing to merge
+        """
+        return None
+
+    def merge_updates(self, updates):
+        pass
+
+    def close(self):
+        """Release the connections of the backend"""
+        pass
+
+    @abc.abstractmethod
+    def source(self):
+        """
+        :return: description of the graph answering the queries, telling whether cached results can be reused
+        """
+
+
+def _files_source(dirpath, fnames):
+    """
+    :return: path, size and modification time of files of a folder, which change whenever the files are rewritten
+    """
+    files = []
+    for fname in fnames:
+        stat = os.stat(os.path.join(dirpath, fname))
+        files.append([fname, stat.st_size, stat.st_mtime_ns])
+    return {"path": os.path.abspath(dirpath), "files": files}
+
+
+class Neo4jGEK(GEKBackend):
+    """GEK queries answered by a running Neo4j instance."""
+
+    def __init__(self, uri, user, password):
+        self.uri = uri
+        self.user = user
+        self.password = password
+
+        self.driver = gutils.connect_to_graph(uri, user, password)
+        self.session = self.driver.session()
+
+    def clone(self):
+        # connections cannot be shared across processes
+        return Neo4jGEK(self.uri, self.user, self.password)
+
+    def close(self):
+        self.session.close()
+        self.driver.close()
+
+    def source(self):
+        return {"backend": "neo4j", "uri": self.uri}
+
+    def top_k(self, form, pos, roles_in, roles_out, K, weight):
+
+        list_in_wo_none, none_in_list_in = split_roles(roles_in)
+        list_out_wo_none, none_in_list_out = split_roles(roles_out)
+
+        query_str_prefix = "MATCH (n:words {form:$form, POS:$pos}) - [a:args] - (e:events) - [a2:args] - (m:words) "
+        query_str_middle = "WHERE NOT m.form IN ['LOCATION', 'PERSON', 'ORGANIZATION'] "
+        query_str_suffix = ""
+
+        if weight == 'pmi':
+            query_str_suffix = " RETURN n.form, a.role, a2.role, sum(a2.pmi) AS PMI, m.form, m.POS " \
+                               " ORDER BY PMI DESC " \
+                               " LIMIT $K "
+        elif weight == "lmi":
+            query_str_suffix = " RETURN n.form, a.role, a2.role, sum(a2.pmi*a2.freq) AS PMI, m.form, m.POS " \
+                               " ORDER BY PMI DESC " \
+                               " LIMIT $K "
+
+        if none_in_list_in:
+            query_str_middle += "AND (a.role in $forms_in OR a.role is null) "
+        else:
+            query_str_middle += "AND (a.role in $forms_in) "
+
+        if none_in_list_out:
+            query_str_middle += "AND (a2.role in $forms_out OR a2.role is null)"
+        else:
+            query_str_middle += "AND (a2.role in $forms_out) "
+
+        query = query_str_prefix+query_str_middle+query_str_suffix
+        logger.debug("performing query: {}".format(query))
+        logger.debug("PARAMETERS: form={}, pos={}, forms_in={}, forms_out={}, K={}".format(
+            form, pos, list_in_wo_none, list_out_wo_none, K))
+
+        data = self.session.run(query, form=form, pos=pos,
+                                forms_in=list_in_wo_none, forms_out=list_out_wo_none, K=K)
+
+        return [(el["m.form"], el["m.POS"], el["PMI"]) for el in data.data()]
+
+    def top_k_batch(self, requests, K, weight):
+        """All the requests are sent as one query, unwinding their parameters, and split on return."""
+
+        query, queries = _batch_query(requests, weight)
+        logger.debug("performing batched query for {} requests".format(len(queries)))
+
+        data = self.session.run(query, queries=queries, K=K)
+
+        return _split_batch(requests, data.data())
+
+
+def _batch_query(requests, weight):
+    queries = []
+    for i, (form, pos, roles_in, roles_out) in enumerate(requests):
+        list_in_wo_none, none_in_list_in = split_roles(roles_in)
+        list_out_wo_none, none_in_list_out = split_roles(roles_out)
+        queries.append({"id": i, "form": form, "pos": pos,
+                        "forms_in": list_in_wo_none, "none_in": none_in_list_in,
+                        "forms_out": list_out_wo_none, "none_out": none_in_list_out})
+
+    if weight == 'pmi':
+        weight_str = "sum(a2.pmi)"
+    elif weight == "lmi":
+        weight_str = "sum(a2.pmi*a2.freq)"
+
+    query = "UNWIND $queries AS q " \
+            "MATCH (n:words {form:q.form, POS:q.pos}) - [a:args] - (e:events) - [a2:args] - (m:words) " \
+            "WHERE NOT m.form IN ['LOCATION', 'PERSON', 'ORGANIZATION'] " \
+            "AND (a.role in q.forms_in OR (q.none_in AND a.role is null)) " \
+            "AND (a2.role in q.forms_out OR (q.none_out AND a2.role is null)) " \
+            "WITH q.id AS id, a.role AS role_in, a2.role AS role_out, m.form AS form, m.POS AS pos, " \
+            + weight_str + " AS PMI " \
+            "ORDER BY PMI DESC " \
+            "WITH id, collect([form, pos, PMI])[..$K] AS neighbours " \
+            "RETURN id, neighbours"
+
+    return query, queries
+
+
+def _split_batch(requests, data):
+    ret = [[] for _ in requests]
+    for el in data:
+        ret[el["id"]] = [tuple(x) for x in el["neighbours"]]
+    return ret
+
+
+class AsyncNeo4jGEK(GEKBackend):
+    """
+    GEK queries answered by a running Neo4j instance through the asyncio driver (neo4j>=5):
+    the batches passed to top_k_batches are all in flight at once, at most `concurrency` at a time.
+    One event loop and one driver, bound to it, serve all the calls.
+    """
+
+    def __init__(self, uri, user, password, concurrency):
+        self.uri = uri
+        self.user = user
+        self.password = password
+        self.concurrency = concurrency
+
+        self.loop = asyncio.new_event_loop()
+        self.driver = self.loop.run_until_complete(self._connect())
+
+    async def _connect(self):
+        return gutils.connect_to_graph_async(self.uri, self.user, self.password)
+
+    def clone(self):
+        # event loops and connections cannot be shared across processes
+        return AsyncNeo4jGEK(self.uri, self.user, self.password, self.concurrency)
+
+    def close(self):
+        self.loop.run_until_complete(self.driver.close())
+        self.loop.close()
+
+    def source(self):
+        return {"backend": "neo4j", "uri": self.uri}
+
+    async def _run_batch(self, driver, semaphore, requests, K, weight):
+        query, queries = _batch_query(requests, weight)
+        async with semaphore:
+            async with driver.session() as session:
+                result = await session.run(query, queries=queries, K=K)
+                data = await result.data()
+        return _split_batch(requests, data)
+
+    async def _run_batches(self, batches, K, weight):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*[self._run_batch(self.driver, semaphore, requests, K, weight)
+                                      for requests in batches])
+
+    def top_k_batches(self, batches, K, weight):
+        logger.info("performing {} batched queries, {} at a time".format(len(batches), self.concurrency))
+        return self.loop.run_until_complete(self._run_batches(batches, K, weight))
+
+    def top_k_batch(self, requests, K, weight):
+        return self.top_k_batches([requests], K, weight)[0]
+
+    def top_k(self, form, pos, roles_in, roles_out, K, weight):
+        return self.top_k_batch([(form, pos, roles_in, roles_out)], K, weight)[0]
+
+
+class LocalGEK(GEKBackend):
+    """
+    GEK queries answered in memory, from the .csv files written by graph_utils.write_graph.
+
+    Edges are kept in numpy arrays sorted by event, so that the co-arguments of a word are found by slicing the
+    events the word takes part in, with no round trip to a database.
+    """
+
+    def __init__(self, graph_dir):
+        logger.info("Loading graph from {}".format(graph_dir))
+        self.graph_dir = graph_dir
+
+        read_csv_kwargs = {"sep": "\t", "dtype": str, "keep_default_na": False, "quoting": csv.QUOTE_NONE}
+
+        words = pd.read_csv(os.path.join(graph_dir, "words_nodes.csv"), **read_csv_kwargs)
+        events = pd.read_csv(os.path.join(graph_dir, "events_nodes.csv"), usecols=[0], **read_csv_kwargs)
+        edges = pd.read_csv(os.path.join(graph_dir, "event-word_edges.csv"), **read_csv_kwargs)
+
+        self.forms = words["form"].values
+        self.pos = words["POS"].values
+        self.index = {(form, pos): i for i, (form, pos) in enumerate(zip(self.forms, self.pos))}
+        self.named_entity = np.isin(self.forms, NAMED_ENTITIES)
+        n_events = len(events)
+
+        # as in neo4j import, edges pointing to missing nodes are ignored
+        edge_event = pd.Index(events.iloc[:, 0]).get_indexer(edges[":START_ID(event-ID)"])
+        edge_word = pd.Index(words.iloc[:, 0]).get_indexer(edges[":END_ID(word-ID)"])
+        keep = (edge_event >= 0) & (edge_word >= 0)
+        edges = edges[keep]
+
+        order = np.argsort(edge_event[keep], kind="stable")
+        edge_role, self.roles = pd.factorize(edges["role"].values[order])
+        self.roles = np.asarray(self.roles)
+
+        self.edge_event = edge_event[keep][order].astype(np.int64)
+        self.edge_word = edge_word[keep][order].astype(np.int64)
+        self.edge_role = edge_role.astype(np.int64)
+        self.edge_pmi = edges["pmi:float"].values[order].astype(np.float64)
+        self.edge_freq = edges["freq:int"].values[order].astype(np.float64)
+
+        # edges of event e are self.event_ptr[e]:self.event_ptr[e+1]
+        self.event_ptr = np.searchsorted(self.edge_event, np.arange(n_events + 1))
+        # edges of word w are self.word_edges[self.word_ptr[w]:self.word_ptr[w+1]]
+        self.word_edges = np.argsort(self.edge_word, kind="stable")
+        self.word_ptr = np.searchsorted(self.edge_word[self.word_edges], np.arange(len(self.forms) + 1))
+
+        self._masks = {}
+
+        logger.info("loaded {} words, {} events, {} edges".format(len(self.forms), n_events, len(self.edge_word)))
+
+    def source(self):
+        return dict(backend="graph", **_files_source(self.graph_dir, ["words_nodes.csv", "events_nodes.csv",
+                                                                      "event-word_edges.csv"]))
+
+    def _role_mask(self, roles):
+        key = tuple(roles)
+        if key not in self._masks:
+            names, accept_none = split_roles(roles)
+            mask = np.isin(self.roles, names)
+            if accept_none:
+                # roles left empty in the .csv files are null properties in neo4j
+                mask |= self.roles == ''
+            self._masks[key] = mask
+        return self._masks[key]
+
+    def top_k_ids(self, word, roles_in, roles_out, K, weight):
+        """Same as top_k, for the word with row `word`: returns the rows of the co-arguments and their weights."""
+
+        own = self.word_edges[self.word_ptr[word]:self.word_ptr[word+1]]
+        own = own[self._role_mask(roles_in)[self.edge_role[own]]]
+
+        # every edge sharing an event with one of the selected edges of the word
+        starts = self.event_ptr[self.edge_event[own]]
+        lengths = self.event_ptr[self.edge_event[own] + 1] - starts
+        co = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        own = np.repeat(own, lengths)
+
+        keep = (co != own) & self._role_mask(roles_out)[self.edge_role[co]] & ~self.named_entity[self.edge_word[co]]
+        own, co = own[keep], co[keep]
+
+        if weight == "pmi":
+            scores = self.edge_pmi[co]
+        elif weight == "lmi":
+            scores = self.edge_pmi[co] * self.edge_freq[co]
+
+        # same grouping as the cypher query: (role of the word, role of the co-argument, co-argument)
+        n_roles, n_words = len(self.roles), len(self.forms)
+        keys = (self.edge_role[own] * n_roles + self.edge_role[co]) * n_words + self.edge_word[co]
+        keys, groups = np.unique(keys, return_inverse=True)
+        totals = np.bincount(groups, weights=scores, minlength=len(keys))
+
+        top = np.argsort(-totals, kind="stable")[:K]
+        return keys[top] % n_words, totals[top]
+
+    def top_k(self, form, pos, roles_in, roles_out, K, weight):
+
+        word = self.index.get((form, pos))
+        if word is None:
+            return []
+
+        words, totals = self.top_k_ids(word, roles_in, roles_out, K, weight)
+        return [(self.forms[w], self.pos[w], float(s)) for w, s in zip(words, totals)]
+
+
+def _index_pairs(relations_map):
+    pairs = set()
+    for rel in relations_map:
+        for box_relation in relations_map:
+            if not rel == box_relation:
+                pairs.add((tuple(relations_map[rel]), tuple(relations_map[box_relation])))
+    return sorted(pairs)
+
+
+def write_gek_index(graph_dir, relations_fpath, output_path, N, weights):
+    """
+    Precompute the top-N co-arguments of every word of the graph, for every pair of relations in the mapping file
+    and every weight, so that GEKIndex can answer queries with a slice.
+
+    The index is a folder holding:
+        - meta.json: N, weights and role pairs, in the order used to lay out the index
+        - vocab.tsv: form and POS of each word, one per line
+        - offsets.npy: neighbours of (word, pair, weight) are in [offsets[i], offsets[i+1]),
+                       with i = (word * n_pairs + pair) * n_weights + weight
+        - neighbours.bin, scores.bin: raw int32 word rows and float32 weights
+    """
+    graph = LocalGEK(graph_dir)
+    relations_map = dutils.load_mapping(relations_fpath)
+    pairs = _index_pairs(relations_map)
+
+    n_words = len(graph.forms)
+    offsets = np.zeros(n_words * len(pairs) * len(weights) + 1, dtype=np.int64)
+
+    with open(os.path.join(output_path, "meta.json"), "w") as fout:
+        json.dump({"N": N, "weights": weights, "pairs": pairs}, fout)
+
+    with open(os.path.join(output_path, "vocab.tsv"), "w") as fout:
+        for form, pos in zip(graph.forms, graph.pos):
+            print("{}\t{}".format(form, pos), file=fout)
+
+    i = 0
+    with open(os.path.join(output_path, "neighbours.bin"), "wb") as fout_n, \
+            open(os.path.join(output_path, "scores.bin"), "wb") as fout_s:
+        for word in tqdm.tqdm(range(n_words), desc="words"):
+            for roles_in, roles_out in pairs:
+                for weight in weights:
+                    neighbours, scores = graph.top_k_ids(word, roles_in, roles_out, N, weight)
+                    neighbours.astype(np.int32).tofile(fout_n)
+                    scores.astype(np.float32).tofile(fout_s)
+                    offsets[i+1] = offsets[i] + len(neighbours)
+                    i += 1
+
+    np.save(os.path.join(output_path, "offsets.npy"), offsets)
+    logger.info("Indexed {} neighbours for {} words and {} relation pairs".format(offsets[-1], n_words, len(pairs)))
+
+
+def _memmap(fpath, dtype):
+    """np.memmap cannot map empty files, which an index without neighbours has"""
+    if not os.path.getsize(fpath):
+        return np.empty(0, dtype=dtype)
+    return np.memmap(fpath, dtype=dtype, mode="r")
+
+
+class GEKIndex(GEKBackend):
+    """GEK queries answered by slicing an index written by write_gek_index, memory-mapped from disk."""
+
+    def __init__(self, index_dir):
+        logger.info("Loading GEK index from {}".format(index_dir))
+        self.index_dir = index_dir
+
+        with open(os.path.join(index_dir, "meta.json")) as fin:
+            meta = json.load(fin)
+        self.N = meta["N"]
+        self.weights = meta["weights"]
+        self.pairs = {(tuple(roles_in), tuple(roles_out)): i for i, (roles_in, roles_out) in enumerate(meta["pairs"])}
+
+        vocab_fpath = os.path.join(index_dir, "vocab.tsv")
+        if os.path.getsize(vocab_fpath):
+            vocab = pd.read_csv(vocab_fpath, sep="\t", header=None, names=["form", "POS"],
+                                dtype=str, keep_default_na=False, quoting=csv.QUOTE_NONE)
+            self.forms = vocab["form"].values
+            self.pos = vocab["POS"].values
+        else:
+            self.forms = self.pos = np.empty(0, dtype=object)
+        self.index = {(form, pos): i for i, (form, pos) in enumerate(zip(self.forms, self.pos))}
+
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"), mmap_mode="r")
+        self.neighbours = _memmap(os.path.join(index_dir, "neighbours.bin"), np.int32)
+        self.scores = _memmap(os.path.join(index_dir, "scores.bin"), np.float32)
+
+    def source(self):
+        return dict(backend="index", **_files_source(self.index_dir, ["meta.json", "vocab.tsv", "offsets.npy",
+                                                                      "neighbours.bin", "scores.bin"]))
+
+    def top_k(self, form, pos, roles_in, roles_out, K, weight):
+
+        pair = self.pairs.get((tuple(roles_in), tuple(roles_out)))
+        if pair is None:
+            raise ValueError("roles {} -> {} are not in the GEK index, "
+                             "rebuild it with the current relations file".format(roles_in, roles_out))
+        if weight not in self.weights:
+            raise ValueError("weight {} is not in the GEK index (available: {})".format(weight, self.weights))
+        if K > self.N:
+            raise ValueError("GEK index holds at most {} neighbours, {} requested".format(self.N, K))
+
+        word = self.index.get((form, pos))
+        if word is None:
+            return []
+
+        i = (word * len(self.pairs) + pair) * len(self.weights) + self.weights.index(weight)
+        start, end = self.offsets[i], min(self.offsets[i+1], self.offsets[i] + K)
+        return [(self.forms[w], self.pos[w], float(s))
+                for w, s in zip(self.neighbours[start:end], self.scores[start:end])]
+
+
+class GEKCache(GEKBackend):
+    """
+    LRU cache in front of a GEK backend, optionally persisted to disk.
+
+    Its size is the number of neighbours held across all cached queries (each query counting at least one), so that
+    memory stays bounded whatever N is. Queries for K neighbours are also answered by entries retrieved with a
+    larger K, hence results extracted with a given -N can be reused by runs with a smaller one.
+    Entries are keyed by word, roles and weight, and hold their K; the file also records the source of the backend,
+    and a file written for another graph is ignored.
+    """
+
+    def __init__(self, backend, max_size, fpath=None):
+        self.backend = backend
+        self.max_size = max_size
+        self.fpath = fpath
+
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # keys put since the last take_updates
+        self.added = []
+
+        if fpath is not None and os.path.exists(fpath):
+            self.load()
+
+    def get(self, key, K):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry_K, results = entry
+            if entry_K >= K or len(results) < entry_K:
+                self.entries.move_to_end(key)
+                return results[:K]
+        return None
+
+    def put(self, key, K, results):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[1]) + 1
+
+        self.entries[key] = (K, results)
+        self.size += len(results) + 1
+        self.added.append(key)
+
+        while self.size > self.max_size and self.entries:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted) + 1
+
+    def top_k(self, form, pos, roles_in, roles_out, K, weight):
+        return self.top_k_batch([(form, pos, roles_in, roles_out)], K, weight)[0]
+
+    def top_k_batch(self, requests, K, weight):
+        """Cached requests are answered from the cache, the others are sent together to the backend."""
+
+        ret = []
+        missing = []
+        for i, (form, pos, roles_in, roles_out) in enumerate(requests):
+            results = self.get((form, pos, tuple(roles_in), tuple(roles_out), weight), K)
+            if results is None:
+                self.misses += 1
+                missing.append(i)
+            else:
+                self.hits += 1
+            ret.append(results)
+
+        if missing:
+            missing_results = self.backend.top_k_batch([requests[i] for i in missing], K, weight)
+            for i, results in zip(missing, missing_results):
+                form, pos, roles_in, roles_out = requests[i]
+                self.put((form, pos, tuple(roles_in), tuple(roles_out), weight), K, results)
+                ret[i] = results
+
+        return ret
+
+    def prefetch(self, requests, K, weight, batch_size):
+        """
+        Fill the cache with the results of all the requests that are not cached yet,
+        sending them to the backend in batches of batch_size requests.
+        """
+        missing = {}
+        for form, pos, roles_in, roles_out in requests:
+            key = (form, pos, tuple(roles_in), tuple(roles_out), weight)
+            if key not in missing and self.get(key, K) is None:
+                missing[key] = (form, pos, roles_in, roles_out)
+
+        logger.info("Prefetching {} GEK queries ({} requested)".format(len(missing), len(requests)))
+
+        missing = list(missing.items())
+        batches = [missing[i:i+batch_size] for i in range(0, len(missing), batch_size)]
+        batches_results = self.backend.top_k_batches([[x[1] for x in batch] for batch in batches], K, weight)
+        for batch, results in zip(batches, batches_results):
+            for (key, _), key_results in zip(batch, results):
+                self.put(key, K, key_results)
+
+        if len(self.entries) < len(missing):
+            logger.warning("GEK cache is too small to hold all prefetched queries, consider increasing its size")
+
+    def clone(self):
+        cache = GEKCache(self.backend.clone(), self.max_size)
+        cache.entries = self.entries.copy()
+        cache.size = self.size
+        return cache
+
+    def take_updates(self):
+        """
+        :return: entries put since the last call, with the hits and misses counted meanwhile
+        """
+        entries = [(key, self.entries[key]) for key in dict.fromkeys(self.added) if key in self.entries]
+        updates = (entries, self.hits, self.misses)
+        self.added = []
+        self.hits = self.misses = 0
+        return updates
+
+    def merge_updates(self, updates):
+        entries, hits, misses = updates
+        for key, (K, results) in entries:
+            if self.get(key, K) is None:
+                self.put(key, K, results)
+        self.hits += hits
+        self.misses += misses
+
+    def log_stats(self):
+        logger.info("GEK cache: {} hits, {} misses, {} queries held "
+                    "({} neighbours)".format(self.hits, self.misses, len(self.entries), self.size))
+
+    def source(self):
+        return self.backend.source()
+
+    def close(self):
+        self.backend.close()
+
+    def load(self):
+        with open(self.fpath, "rb") as fin:
+            cached = pickle.load(fin)
+        if not isinstance(cached, dict) or cached["source"] != self.source():
+            logger.warning("GEK cache file {} was not written for this graph, it is ignored "
+                           "and will be overwritten".format(self.fpath))
+            return
+        for key, (K, results) in cached["entries"]:
+            self.put(key, K, results)
+        self.added = []
+        logger.info("Loaded {} cached GEK queries from {}".format(len(self.entries), self.fpath))
+
+    def save(self):
+        if self.fpath is not None:
+            with open(self.fpath, "wb") as fout:
+                pickle.dump({"source": self.source(), "entries": list(self.entries.items())}, fout)
+            logger.info("Saved {} cached GEK queries to {}".format(len(self.entries), self.fpath))
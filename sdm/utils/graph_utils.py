@@ -27,24 +27,35 @@ def connect_to_graph(uri, user, password):
     return driver
 
 
-def write_graph(stats_path, events_path, output_path):
-    lemmas = dutils.load_freqs(stats_path)
-    events = dutils.load_freqs(events_path)
+def connect_to_graph_async(uri, user, password):
+    try:
+        from neo4j import AsyncGraphDatabase
+    except ImportError:
+        raise ImportError("asynchronous queries need neo4j>=5, install sdm[async]")
+
+    driver = AsyncGraphDatabase.driver(uri, auth=(user, password))
+
+    return driver
+
 
+def write_graph(stats_path, events_path, output_path):
+    """
+    Write the neo4j import files of the graph, streaming the frequency files: lemmas and events are read twice each,
+    first for the totals and then to write nodes and edges, so that only the ids of lemmas are held in memory.
+    Nodes are numbered in order of the frequency files.
+    """
     lemmas_idx = {}
-    events_idx = {}
 
     N_lemmas = dutils.count_absolute_freq(stats_path)
     n_events_dic = dutils.load_n_events_freq(events_path)
 
     # write word nodes
     output_file = os.path.join(output_path, "words_nodes.csv")
-    with open(output_file, 'w') as writer:
+    with dutils.open_freqs(stats_path) as fin, open(output_file, 'w') as writer:
         header = '\t'.join(['wordId:ID(word-ID)', 'form', 'POS', 'freq:int', 'prob:float'])
         writer.write(header + "\n")
-        for c, lemma in enumerate(lemmas):
-            c=c+1
-            lemma_pos, freq = lemma
+        for c, line in enumerate(fin, 1):
+            lemma_pos, freq = line.strip().split("\t")
             lemma, pos = lemma_pos.split(" ")
             freq = float(freq)
             prob = freq / N_lemmas
@@ -52,38 +63,29 @@ def write_graph(stats_path, events_path, output_path):
             writer.write(line + "\n")
             lemmas_idx["{}@{}".format(lemma, pos)] = str(c)
 
-    # write event nodes
-    output_file = os.path.join(output_path, "events_nodes.csv")
-    with open(output_file, 'w') as writer:
+    # write event nodes and event-word edges
+    nodes_file = os.path.join(output_path, "events_nodes.csv")
+    edges_file = os.path.join(output_path, "event-word_edges.csv")
+    with dutils.open_freqs(events_path) as fin, open(nodes_file, 'w') as nodes_writer, \
+            open(edges_file, 'w') as edges_writer:
         header = '\t'.join(['eventId:ID(event-ID)', 'form', 'freq:int', 'prob:float', 'deg:int'])
-        writer.write(header + "\n")
-        for c, event in enumerate(events):
-            c=c+1
-            event, freq = event
-            n = len(event.split(" "))
-            event = event.replace(" ", ",")
+        nodes_writer.write(header + "\n")
+        header = '\t'.join([':START_ID(event-ID)', 'freq:int', 'prob:float', 'pmi:float', 'degree:int', 'role', ':END_ID(word-ID)'])
+        edges_writer.write(header + "\n")
+        for c, line in enumerate(fin, 1):
+            event, freq = line.strip().split("\t")
+            members = event.split(" ")
+            n = len(members)
             freq = float(freq)
             prob = freq / n_events_dic[n]
-            line = '\t'.join([str(c), event, str(int(freq)), str(prob), str(n)])
-            writer.write(line + "\n")
-            events_idx[event] = str(c)
+            line = '\t'.join([str(c), ",".join(members), str(int(freq)), str(prob), str(n)])
+            nodes_writer.write(line + "\n")
 
-    # write event-word edges
-    output_file = os.path.join(output_path, "event-word_edges.csv")
-    with open(output_file, 'w') as writer:
-        header = '\t'.join([':START_ID(event-ID)', 'freq:int', 'prob:float', 'pmi:float', 'degree:int', 'role', ':END_ID(word-ID)'])
-        writer.write(header + "\n")
-        for c, event in enumerate(events):
-            c = c + 1
-            event, freq = event
-            freq = int(float(freq))
-            event_form = event.replace(" ", ",")
-            for w in event.split():
+            for w in members:
                 l,p,r = w.split("@")
                 lemma_pos = "{}@{}".format(l,p)
-                deg = len(event.split(" "))
-                line = "\t".join([events_idx[event_form], str(freq), "0.0", "0.0", str(deg), r, lemmas_idx[lemma_pos]])
-                writer.write(line + "\n")
+                line = "\t".join([str(c), str(int(freq)), "0.0", "0.0", str(n), r, lemmas_idx[lemma_pos]])
+                edges_writer.write(line + "\n")
                 # TO DO: compute frequency
 
 
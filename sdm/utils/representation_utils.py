@@ -2,10 +2,84 @@ import numpy as np
 import copy
 
 
+class WeightedList:
+    """
+    A weighted list of (label, vector, weight) items, stored as a list of labels, an (n x d) matrix of vectors and
+    an array of weights. Iterating over it or indexing it gives back (label, vector, weight) tuples.
+    """
+
+    def __init__(self, labels, matrix, weights, norms=None):
+        self.labels = labels
+        self.matrix = matrix
+        self.weights = weights
+        self.norms = norms
+        # centroids of the first n rows, by n
+        self.centroids = {}
+
+    @classmethod
+    def from_items(cls, items):
+        if not len(items):
+            return cls([], np.empty((0, 0)), np.empty(0))
+
+        matrix = np.stack([vector for _, vector, _ in items])
+        # vectors stored as float16 are summed at single precision at least
+        matrix = matrix.astype(np.result_type(matrix.dtype, np.float32), copy=False)
+        return cls([label for label, _, _ in items], matrix, np.array([w for _, _, w in items], dtype=float))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __iter__(self):
+        return zip(self.labels, self.matrix, self.weights)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return WeightedList(self.labels[i], self.matrix[i], self.weights[i],
+                                None if self.norms is None else self.norms[i])
+        return self.labels[i], self.matrix[i], self.weights[i]
+
+    def get_norms(self):
+        if self.norms is None:
+            self.norms = np.linalg.norm(self.matrix, axis=1)
+        return self.norms
+
+    def with_weights(self, weights):
+        # same rows in the same order, so the centroids still hold
+        ret = WeightedList(self.labels, self.matrix, weights, self.norms)
+        ret.centroids = self.centroids
+        return ret
+
+    def ranked(self):
+        """
+        Same items sorted by decreasing weight (ties keep their order).
+        Centroids of the first n rows are kept when reranking leaves the set of the first n rows unchanged.
+        """
+        order = np.argsort(-self.weights, kind="stable")
+        ret = WeightedList([self.labels[i] for i in order], self.matrix[order], self.weights[order],
+                           None if self.norms is None else self.norms[order])
+
+        for n, centroid in self.centroids.items():
+            head = np.sort(order[:n])
+            if np.array_equal(head, np.arange(len(head))):
+                ret.centroids[n] = centroid
+
+        return ret
+
+    def head_centroid(self, n):
+        if n not in self.centroids:
+            self.centroids[n] = self.matrix[:n].mean(axis=0)
+        return self.centroids[n]
+
+
 def _centroid(list_of_lists, n):
     centroids = []
 
     for sub_list in list_of_lists:
+        if isinstance(sub_list, WeightedList):
+            if len(sub_list):
+                centroids.append(sub_list.head_centroid(n))
+            continue
+
         centroid = None
         n_summed = 0
 
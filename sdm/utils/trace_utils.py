@@ -0,0 +1,24 @@
+import json
+
+OFF, SUMMARY, FULL = 0, 1, 2
+
+levels = {"off": OFF, "summary": SUMMARY, "full": FULL}
+
+
+class Trace:
+    """
+    Step-by-step trace of the model, written as one JSON record per line.
+    With level summary, a record is written for each dataset item and each processed word; with level full, the
+    extracted GEK and the content of LC and AC are dumped after every update as well.
+    Callers check `summary` and `full` before building a record, so that nothing is built when tracing is off.
+    """
+
+    def __init__(self, fout, level):
+        self.fout = fout
+        self.summary = level >= SUMMARY
+        self.full = level >= FULL
+
+    def write(self, step, **fields):
+        record = {"step": step}
+        record.update(fields)
+        self.fout.write(json.dumps(record) + "\n")
@@ -0,0 +1,123 @@
+import gzip
+import logging
+import itertools
+
+from sdm.utils import data_utils as dutils
+
+logger = logging.getLogger(__name__)
+
+# a member of an event is packed in one integer as lemma_id << REL_BITS | relation_id
+REL_BITS = 10
+REL_MASK = (1 << REL_BITS) - 1
+
+# packed members are written as fixed width hexadecimal strings, so that sorting encoded events as strings sorts
+# them as tuples of integers
+_MEMBER_FORMAT = "{:09x}"
+# the same holds for members packed as fixed width big-endian bytes, in binary runs
+_MEMBER_BYTES = 5
+# packed members fit in 9 hexadecimal digits, which bounds lemma ids
+MAX_LEMMAS = 1 << (36 - REL_BITS)
+
+
+class Vocabulary:
+    """
+    Integer ids of hashable items, consistent among processes.
+    Seed items are numbered in sorted order in advance. Any other item is numbered the first time it is seen by any
+    process, through a dictionary held by a multiprocessing manager, and is memoized by each process.
+    """
+
+    def __init__(self, manager, seed=()):
+        self.ids = {item: i for i, item in enumerate(sorted(seed))}
+        self.n_seed = len(self.ids)
+        self.shared = manager.dict()
+        self.lock = manager.Lock()
+
+    def __getitem__(self, item):
+        try:
+            return self.ids[item]
+        except KeyError:
+            with self.lock:
+                i = self.shared.get(item)
+                if i is None:
+                    i = self.n_seed + len(self.shared)
+                    self.shared[item] = i
+            self.ids[item] = i
+            return i
+
+    def items(self):
+        """
+        :return: list of items, indexed by their id
+        """
+        ret = [None] * (self.n_seed + len(self.shared))
+        for item, i in itertools.chain(self.ids.items(), self.shared.items()):
+            ret[i] = item
+        return ret
+
+
+def pack(lemma_id, relation_id):
+    if relation_id > REL_MASK:
+        raise ValueError("more than {} relations cannot be packed in events".format(REL_MASK + 1))
+    if lemma_id >= MAX_LEMMAS:
+        raise ValueError("more than {} lemmas cannot be packed in events".format(MAX_LEMMAS))
+    return lemma_id << REL_BITS | relation_id
+
+
+def encode_event(event):
+    """
+    :param tuple event: sorted packed members
+    :return: the event as a string of space separated, fixed width members
+    """
+    return " ".join(_MEMBER_FORMAT.format(member) for member in event)
+
+
+def encode_event_bytes(event):
+    """
+    :param tuple event: sorted packed members
+    :return: the event as the concatenation of fixed width members
+    """
+    return b"".join(member.to_bytes(_MEMBER_BYTES, "big") for member in event)
+
+
+class EventDecoder:
+    """
+    Turns encoded events, as str or bytes, into space separated lemma@pos@relation members, sorted.
+    """
+
+    def __init__(self, lemmas, relations):
+        """
+        :param list lemmas: (lemma, pos) tuples indexed by id
+        :param list relations: relations indexed by id
+        """
+        self.lemmas = lemmas
+        self.relations = relations
+        self.members = {}
+
+    def member(self, packed):
+        if packed not in self.members:
+            lemma, pos = self.lemmas[packed >> REL_BITS]
+            self.members[packed] = "{}@{}@{}".format(lemma, pos, self.relations[packed & REL_MASK])
+        return self.members[packed]
+
+    def __call__(self, key):
+        if isinstance(key, bytes):
+            packed = (int.from_bytes(key[i:i + _MEMBER_BYTES], "big") for i in range(0, len(key), _MEMBER_BYTES))
+        else:
+            packed = (int(member, 16) for member in key.split(" "))
+        return " ".join(sorted(self.member(member) for member in packed))
+
+
+def decode_events(fpath, output_fpath, lemmas, relations):
+    """
+    Write the events of a frequency file with encoded events to a gzipped frequency file, as space separated
+    lemma@pos@relation members, sorted.
+
+    :param list lemmas: (lemma, pos) tuples indexed by id
+    :param list relations: relations indexed by id
+    """
+    decode = EventDecoder(lemmas, relations)
+    with dutils.open_freqs(fpath) as fin, gzip.open(output_fpath, "wt") as fout:
+        for line in fin:
+            key, freq = line.rstrip("\n").split("\t")
+            print("{}\t{}".format(decode(key), freq), file=fout)
+
+    logger.info("Decoded events using {} lemmas and {} relations".format(len(lemmas), len(relations)))
@@ -1,14 +1,26 @@
-from scipy.spatial import distance
+import numpy as np
 
+from sdm.utils import representation_utils as rutils
 
-def _cosine(list_of_items, head_vector):
 
-    new_list_of_items = []
-    for label, vector, w in list_of_items:
-        score = 1-distance.cosine(vector, head_vector)
-        new_list_of_items.append((label, vector, score))
+def _batch_cosine(list_of_items, head_vector):
+    # cosine of each item with the head vector, computed with one matrix-vector product over the whole list
 
-    return new_list_of_items
+    if isinstance(list_of_items, rutils.WeightedList):
+        if not len(list_of_items):
+            return list_of_items
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = list_of_items.matrix.dot(head_vector) / (list_of_items.get_norms() * np.linalg.norm(head_vector))
+        return list_of_items.with_weights(scores)
 
+    if not len(list_of_items):
+        return []
 
-possible_functions = {'cosine': _cosine}
+    matrix = np.stack([vector for _, vector, _ in list_of_items])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = matrix.dot(head_vector) / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(head_vector))
+
+    return [(label, vector, score) for (label, vector, _), score in zip(list_of_items, scores)]
+
+
+possible_functions = {'cosine': _batch_cosine}
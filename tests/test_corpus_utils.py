@@ -0,0 +1,131 @@
+import os
+import random
+
+import pytest
+
+from sdm.utils import corpus_utils as cutils
+
+_POS = ["N", "V", "J"]
+_RELS = ["nsubj", "dobj", "amod", "compound"]
+_LEMMAS = ["dog", "Cat", "bite", "she", "they", "red", "up", "a", "1990", "x$y", "New-York"]
+_UPOS = ["NN", "NNS", "NNP", "VB", "VBZ", "JJ", "DT", "PRP", "RP"]
+_DEPRELS = ["nsubj", "dobj", "amod", "compound:prt", "nsubjpass", "nmod:agent", "det", "root"]
+
+
+def _write_conll(fpath, seed, n_sentences=50):
+    rnd = random.Random(seed)
+    with open(fpath, "w") as fout:
+        for _ in range(n_sentences):
+            n_tokens = rnd.randint(1, 8)
+            for i in range(1, n_tokens + 1):
+                lemma = rnd.choice(_LEMMAS)
+                deprels = ",".join("{}={}".format(rnd.choice(_DEPRELS), rnd.randint(0, n_tokens))
+                                   for _ in range(rnd.randint(1, 2)))
+                if rnd.random() < 0.02:
+                    deprels += ",dobj"
+                print(i, lemma, lemma, rnd.choice(_UPOS), rnd.choice(["O", "O", "PERSON"]), deprels, file=fout)
+            print(file=fout)
+
+
+def _events(words, dependencies, accepted_lemmas):
+    """
+    :return: sorted (head lemma, head pos, dependent lemma, dependent pos, role) of the dependencies extract_patterns
+             counts
+    """
+    return sorted((words[head].lemma, words[head].upos, words[dep_id].lemma, words[dep_id].upos, role)
+                  for head, head_deps in dependencies.items() for dep_id, role in head_deps
+                  if not len(accepted_lemmas) or (words[dep_id].lemma, words[dep_id].upos) in accepted_lemmas)
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("accepted_lemmas", [set(), {("dog", "N"), ("PERSON", "N"), ("bite", "V"), ("red", "J")}])
+def test_events_reader_as_conll_reader_and_dependency_builder(tmp_path, seed, accepted_lemmas):
+    filepaths = []
+    for i in range(2):
+        filepaths.append(str(tmp_path / "corpus-{}.conll".format(i)))
+        _write_conll(filepaths[-1], seed * 2 + i)
+
+    expected = []
+    for batch in cutils.CoNLLReader(" ", filepaths, batch_size=7):
+        for built in cutils.DependencyBuilder(_POS, _RELS, batch):
+            for words, dependencies in built:
+                events = _events(words, dependencies, accepted_lemmas)
+                if len(events):
+                    expected.append(events)
+
+    batches = list(cutils.EventsReader(" ", _POS, _RELS, accepted_lemmas, filepaths, batch_size=7))
+    assert all(len(batch) <= 7 for batch in batches)
+    assert [_events(words, dependencies, accepted_lemmas)
+            for batch in batches for words, dependencies in batch] == expected
+    assert len(expected)
+
+
+def _write_cache(cache_dir, filepaths):
+    """
+    :return: the sentences written to a corpus cache in cache_dir, as the stats pass writes them
+    """
+    sentences = []
+    for i, batch in enumerate(cutils.CoNLLReader(" ", filepaths, batch_size=7)):
+        writer = cutils.CorpusCacheWriter(str(cache_dir / "{:03d}.gz".format(i)))
+        for built in cutils.DependencyBuilder(_POS, _RELS, batch):
+            for words, dependencies in built:
+                writer.write(words, dependencies)
+                sentences.append((words, dependencies))
+        writer.close()
+    return sentences
+
+
+@pytest.mark.parametrize("accepted_lemmas", [set(), {("dog", "N"), ("PERSON", "N"), ("bite", "V"), ("red", "J")}])
+def test_cache_reader_round_trip(tmp_path, accepted_lemmas):
+    filepaths = []
+    for i in range(2):
+        filepaths.append(str(tmp_path / "corpus-{}.conll".format(i)))
+        _write_conll(filepaths[-1], i)
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+
+    expected = []
+    for words, dependencies in _write_cache(cache_dir, filepaths):
+        events = _events(words, dependencies, accepted_lemmas)
+        if len(events):
+            expected.append(events)
+
+    cache_fpaths = sorted(str(fpath) for fpath in cache_dir.glob("*.gz"))
+    batches = list(cutils.CacheReader(accepted_lemmas, cache_fpaths, batch_size=7))
+    assert all(len(batch) <= 7 for batch in batches)
+    assert [_events(words, dependencies, accepted_lemmas)
+            for batch in batches for words, dependencies in batch] == expected
+    assert len(expected)
+
+
+def test_cache_manifest_tracks_input_files_and_labels(tmp_path):
+    filepaths = []
+    for i in range(2):
+        filepaths.append(str(tmp_path / "corpus-{}.conll".format(i)))
+        _write_conll(filepaths[-1], i)
+    cache_dir = str(tmp_path) + "/"
+
+    assert cutils.read_cache_manifest(cache_dir) is None
+
+    cutils.write_cache_manifest(cache_dir, filepaths, _POS, _RELS, " ")
+    assert cutils.read_cache_manifest(cache_dir) == cutils.cache_manifest(filepaths[::-1], _POS, _RELS, " ")
+
+    assert cutils.read_cache_manifest(cache_dir) != cutils.cache_manifest(filepaths[:1], _POS, _RELS, " ")
+    assert cutils.read_cache_manifest(cache_dir) != cutils.cache_manifest(filepaths, _POS[:2], _RELS, " ")
+    assert cutils.read_cache_manifest(cache_dir) != cutils.cache_manifest(filepaths, _POS, _RELS[:2], " ")
+    assert cutils.read_cache_manifest(cache_dir) != cutils.cache_manifest(filepaths, _POS, _RELS, "\t")
+
+    stat = os.stat(filepaths[0])
+    os.utime(filepaths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert cutils.read_cache_manifest(cache_dir) != cutils.cache_manifest(filepaths, _POS, _RELS, " ")
+
+    cutils.write_cache_manifest(cache_dir, filepaths, _POS, _RELS, " ")
+    stat = os.stat(filepaths[1])
+    with open(filepaths[1], "a") as fout:
+        print(file=fout)
+    os.utime(filepaths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cutils.read_cache_manifest(cache_dir) != cutils.cache_manifest(filepaths, _POS, _RELS, " ")
+
+    with open(cache_dir + cutils.CACHE_MANIFEST, "w") as fout:
+        fout.write("{")
+    assert cutils.read_cache_manifest(cache_dir) is None
@@ -0,0 +1,97 @@
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+from sdm.utils import data_utils as dutils
+
+
+def _write_vectors(fpath, header, rows):
+    with open(fpath, "w") as fout:
+        print(header, file=fout)
+        for row in rows:
+            print(row, file=fout)
+
+
+def test_convert_vectors_keeps_last_dims(tmp_path):
+    vectors_fpath = str(tmp_path / "vectors.txt")
+    _write_vectors(vectors_fpath, "2 3", ["dog 1 2 3", "cat 4 5 6"])
+    output_fpath = str(tmp_path / "vectors.npy")
+
+    dutils.convert_vectors(vectors_fpath, output_fpath, len_vectors=2)
+
+    converted = dutils.load_vectors(output_fpath, False, set(), -1)
+    in_memory = dutils.load_vectors(vectors_fpath, False, set(), 2)
+    for word in (("dog", "N"), ("cat", "N")):
+        np.testing.assert_array_equal(converted[word], in_memory[word])
+    np.testing.assert_array_equal(converted["dog", "N"], [2, 3])
+
+
+def test_convert_vectors_more_rows_than_header(tmp_path):
+    vectors_fpath = str(tmp_path / "vectors.txt")
+    _write_vectors(vectors_fpath, "1 2", ["dog 1 2", "cat 3 4"])
+
+    with pytest.raises(ValueError, match="more vectors"):
+        dutils.convert_vectors(vectors_fpath, str(tmp_path / "vectors.npy"))
+
+
+def test_load_results_binary_older_than_results(tmp_path):
+    out_fpath = str(tmp_path / "data.tsv.out")
+    with open(out_fpath, "w") as fout:
+        print("item\tLC_vector\tAC_vector", file=fout)
+    dutils.dump_results_binary([(np.ones(2), None)], out_fpath)
+
+    assert dutils.load_results_binary(out_fpath)[0].shape == (1, 2)
+
+    mtime = os.path.getmtime(out_fpath)
+    os.utime(out_fpath+".AC.npy", (mtime - 10, mtime - 10))
+    assert dutils.load_results_binary(out_fpath) is None
+
+
+def test_sort_freqs(tmp_path):
+    fname = str(tmp_path / "freqs.gz")
+    with gzip.open(fname, "wt") as fout:
+        for key, freq in [("b x", "2"), ("a", "1.0"), ("c", "3"), ("a b", "4")]:
+            print("{}\t{}".format(key, freq), file=fout)
+
+    output_fname = str(tmp_path / "sorted.gz")
+    dutils.sort_freqs(fname, output_fname, str(tmp_path) + "/", max_keys=3)
+
+    with gzip.open(output_fname, "rt") as fin:
+        assert fin.read().splitlines() == ["a\t1.0", "a b\t4.0", "b x\t2.0", "c\t3.0"]
+    assert sorted(os.listdir(tmp_path)) == ["freqs.gz", "sorted.gz"]
+
+
+def test_merge_sorted_runs_in_rounds(tmp_path):
+    fnames = []
+    for i in range(5):
+        fname = str(tmp_path / "run-{}.gz".format(i))
+        with gzip.open(fname, "wt") as fout:
+            print("a\t1", file=fout)
+            print("k{}\t{}".format(i, i), file=fout)
+        fnames.append(fname)
+
+    output_fname = str(tmp_path / "merged.gz")
+    assert dutils.merge_sorted_runs(fnames, output_fname, min_freq=1, batch_size=2) == (5, 1)
+
+    with gzip.open(output_fname, "rt") as fin:
+        assert fin.read().splitlines() == ["a\t5.0", "k1\t1.0", "k2\t2.0", "k3\t3.0", "k4\t4.0"]
+    assert os.listdir(tmp_path) == ["merged.gz"]
+
+
+def test_merge_binary_runs_in_rounds(tmp_path):
+    fnames = []
+    for i in range(5):
+        fname = str(tmp_path / "run-{}.gz".format(i))
+        with gzip.open(fname, "wb") as fout:
+            for key, freq in sorted([(b"a", 200), ("k{}".format(i).encode(), i + 1)]):
+                fout.write(dutils.varint(len(key)) + key + dutils.varint(freq))
+        fnames.append(fname)
+
+    output_fname = str(tmp_path / "merged.gz")
+    assert dutils.merge_sorted_runs(fnames, output_fname, decode_key=bytes.decode, batch_size=2) == (6, 0)
+
+    with gzip.open(output_fname, "rt") as fin:
+        assert fin.read().splitlines() == ["a\t1000.0", "k0\t1.0", "k1\t2.0", "k2\t3.0", "k3\t4.0", "k4\t5.0"]
+    assert os.listdir(tmp_path) == ["merged.gz"]
@@ -0,0 +1,53 @@
+import numpy as np
+
+from sdm.core import evaluation
+from sdm.utils import data_utils as dutils
+
+
+def _write_results(tmp_path, res):
+    (tmp_path / "data.tsv").write_text("item\ttarget-relation\n" + "".join("x@N@nsubj\tSENTENCE\n" for _ in res))
+    out_fpath = str(tmp_path / "data.tsv.out")
+    dutils.dump_results(str(tmp_path / "data.tsv"), res, out_fpath)
+    return out_fpath
+
+
+def test_load_AC_vectors_from_text(tmp_path):
+    out_fpath = _write_results(tmp_path, [(None, np.array([1., 2.])), (None, None)])
+
+    AC_vectors, AC_mask = evaluation.Evaluation(None, out_fpath, None).load_AC_vectors()
+
+    np.testing.assert_array_equal(AC_vectors, [[1, 2], [np.nan, np.nan]])
+    np.testing.assert_array_equal(AC_mask, [True, False])
+
+
+def test_load_AC_vectors_from_binary_skips_text(tmp_path, monkeypatch):
+    res = [(None, np.array([1., 2.])), (None, None)]
+    out_fpath = _write_results(tmp_path, res)
+    dutils.dump_results_binary(res, out_fpath)
+
+    def read_csv(*args, **kwargs):
+        raise AssertionError("the text output is parsed")
+    monkeypatch.setattr(evaluation.pd, "read_csv", read_csv)
+
+    AC_vectors, AC_mask = evaluation.Evaluation(None, out_fpath, None).load_AC_vectors()
+
+    np.testing.assert_array_equal(AC_vectors, [[1, 2], [np.nan, np.nan]])
+    np.testing.assert_array_equal(AC_mask, [True, False])
+
+
+def test_ks_evaluation_leaves_out_missing_vectors(tmp_path, capsys):
+    vectors = [[1, 0], [1, 1], [0, 1], [1, 2], [2, 1], [1, 0], [3, 1], [1, 3], [1, 1], None]
+    res = [(None, None if v is None else np.array(v, dtype=float)) for v in vectors]
+    out_fpath = _write_results(tmp_path, res)
+    (tmp_path / "mapping.csv").write_text("".join("{}\t{}\t{}\n".format(i, 2 * i, 2 * i + 1) for i in range(5)))
+    (tmp_path / "KS.csv").write_text("score\n" + "".join("{}\n".format(score) for score in [1, 5, 2, 4, 3]))
+
+    evaluation.Evaluation(str(tmp_path / "KS.csv"), out_fpath, str(tmp_path),
+                          mapping_fpath=str(tmp_path / "mapping.csv")).ks_evaluation()
+
+    sims = evaluation.batch_cosine([vectors[0], vectors[2], vectors[4], vectors[6]],
+                                   [vectors[1], vectors[3], vectors[5], vectors[7]])
+    expected = evaluation.spearmanr([1, 5, 2, 4], sims)
+    assert capsys.readouterr().out.strip() == str(expected)
+    assert np.isnan(evaluation.ks_similarities(evaluation.Evaluation(None, out_fpath, None).load_AC_vectors()[0],
+                                               [8], [9])).all()
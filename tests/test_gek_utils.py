@@ -0,0 +1,245 @@
+import collections
+import json
+import os
+import random
+
+import numpy as np
+import pytest
+
+from sdm.utils import gek_utils as gekutils
+
+
+class _Session:
+    """Records the queries run by a Neo4jGEK, returning no rows."""
+
+    class _Result:
+        def data(self):
+            return []
+
+    def __init__(self):
+        self.queries = []
+
+    def run(self, query, **params):
+        self.queries.append((query, params))
+        return self._Result()
+
+
+def _neo4j_gek():
+    gek = gekutils.Neo4jGEK.__new__(gekutils.Neo4jGEK)
+    gek.session = _Session()
+    return gek
+
+
+def test_top_k_batch_query():
+    gek = _neo4j_gek()
+    requests = [("dog", "N", ("nsubj",), ("dobj", "None")), ("eat", "V", ("None",), ("nsubj",))]
+
+    assert gek.top_k_batch(requests, 10, "pmi") == [[], []]
+
+    (query, params), = gek.session.queries
+    assert "MATCH (n:words {form:q.form, POS:q.pos})" in query
+    assert "sum(a2.pmi) AS PMI" in query
+    assert params["K"] == 10
+    assert [q["id"] for q in params["queries"]] == [0, 1]
+    assert params["queries"][0]["none_out"] and not params["queries"][0]["none_in"]
+
+
+def test_top_k_batch_query_lmi():
+    gek = _neo4j_gek()
+    gek.top_k_batch([("dog", "N", ("nsubj",), ("dobj",))], 5, "lmi")
+
+    (query, _), = gek.session.queries
+    assert "sum(a2.pmi*a2.freq) AS PMI" in query
+
+
+def test_empty_gek_index(tmp_path):
+    with open(tmp_path / "meta.json", "w") as fout:
+        json.dump({"N": 5, "weights": ["pmi"], "pairs": [[["nsubj"], ["dobj"]]]}, fout)
+    (tmp_path / "vocab.tsv").write_text("")
+    (tmp_path / "neighbours.bin").write_bytes(b"")
+    (tmp_path / "scores.bin").write_bytes(b"")
+    np.save(str(tmp_path / "offsets.npy"), np.zeros(1, dtype=np.int64))
+
+    index = gekutils.GEKIndex(str(tmp_path))
+
+    assert index.top_k("dog", "N", ["nsubj"], ["dobj"], 5, "pmi") == []
+
+
+class _Backend(gekutils.GEKBackend):
+    """Backend answering every query with the same neighbours, counting the queries it receives."""
+
+    def __init__(self, name, neighbours):
+        self.name = name
+        self.neighbours = neighbours
+        self.queries = 0
+
+    def source(self):
+        return {"backend": self.name}
+
+    def top_k(self, form, pos, roles_in, roles_out, K, weight):
+        self.queries += 1
+        return self.neighbours[:K]
+
+
+def test_gek_cache_file(tmp_path):
+    fpath = str(tmp_path / "gek.cache")
+    cache = gekutils.GEKCache(_Backend("a", [("cat", "N", 1.0)]), 100, fpath)
+    cache.top_k("dog", "N", ["nsubj"], ["dobj"], 5, "pmi")
+    cache.save()
+
+    same = gekutils.GEKCache(_Backend("a", []), 100, fpath)
+    assert same.top_k("dog", "N", ["nsubj"], ["dobj"], 5, "pmi") == [("cat", "N", 1.0)]
+    assert same.backend.queries == 0
+
+    other = gekutils.GEKCache(_Backend("b", []), 100, fpath)
+    assert other.top_k("dog", "N", ["nsubj"], ["dobj"], 5, "pmi") == []
+    assert other.backend.queries == 1
+
+
+def test_gek_cache_updates_of_clone():
+    cache = gekutils.GEKCache(_Backend("a", [("cat", "N", 1.0)]), 100)
+    cache.top_k("dog", "N", ["nsubj"], ["dobj"], 5, "pmi")
+
+    clone = cache.clone()
+    clone.top_k("dog", "N", ["nsubj"], ["dobj"], 5, "pmi")
+    clone.top_k("eat", "V", ["nsubj"], ["dobj"], 5, "pmi")
+    cache.merge_updates(clone.take_updates())
+
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.get(("eat", "V", ("nsubj",), ("dobj",), "pmi"), 5) == [("cat", "N", 1.0)]
+    assert clone.take_updates() == ([], 0, 0)
+
+
+class _AsyncDriver:
+    """Asyncio driver with sessions answering no rows, counting the drivers created and closed."""
+
+    created = 0
+    closed = 0
+
+    class _Session:
+        class _Result:
+            async def data(self):
+                return []
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def run(self, query, **params):
+            return self._Result()
+
+    def __init__(self):
+        _AsyncDriver.created += 1
+
+    def session(self):
+        return self._Session()
+
+    async def close(self):
+        _AsyncDriver.closed += 1
+
+
+def test_async_gek_keeps_one_driver(monkeypatch):
+    monkeypatch.setattr(gekutils.gutils, "connect_to_graph_async", lambda uri, user, password: _AsyncDriver())
+    gek = gekutils.AsyncNeo4jGEK("bolt://localhost", "neo4j", "neo4j", 2)
+
+    request = ("dog", "N", ("nsubj",), ("dobj",))
+    assert gek.top_k_batches([[request], [request, request]], 5, "pmi") == [[[]], [[], []]]
+    assert gek.top_k_batch([request], 5, "pmi") == [[]]
+    gek.close()
+
+    assert (_AsyncDriver.created, _AsyncDriver.closed) == (1, 1)
+
+
+_WORDS = [("dog", "N"), ("cat", "N"), ("eat", "V"), ("bone", "N"), ("PERSON", "N"), ("big", "J")]
+_ROLES = ["nsubj", "dobj", "amod", ""]
+
+
+def _write_graph_csvs(graph_dir, seed=0):
+    """
+    Random graph in the format of graph_utils.write_graph, with integer pmi values so that scores tie.
+    :return: edges as (event, word row, role, pmi, freq) tuples
+    """
+    rng = random.Random(seed)
+    with open(graph_dir / "words_nodes.csv", "w") as fout:
+        print("wordId:ID(word-ID)\tform\tPOS\tfreq:int\tprob:float", file=fout)
+        for i, (form, pos) in enumerate(_WORDS, 1):
+            print("{}\t{}\t{}\t1\t0.1".format(i, form, pos), file=fout)
+
+    edges = []
+    with open(graph_dir / "events_nodes.csv", "w") as fout:
+        print("eventId:ID(event-ID)\tform\tfreq:int\tprob:float\tdeg:int", file=fout)
+        for event in range(1, 31):
+            freq = rng.randint(1, 5)
+            members = rng.sample(range(len(_WORDS)), rng.randint(2, 4))
+            print("{}\tx\t{}\t0.1\t{}".format(event, freq, len(members)), file=fout)
+            for word in members:
+                edges.append((event, word, rng.choice(_ROLES), rng.randint(-2, 3), freq))
+
+    with open(graph_dir / "event-word_edges.csv", "w") as fout:
+        print(":START_ID(event-ID)\tfreq:int\tprob:float\tpmi:float\tdegree:int\trole\t:END_ID(word-ID)",
+              file=fout)
+        for event, word, role, pmi, freq in edges:
+            print("{}\t{}\t0.1\t{}\t2\t{}\t{}".format(event, freq, pmi, role, word + 1), file=fout)
+
+    return edges
+
+
+def _brute_force_top_k(edges, form, pos, roles_in, roles_out, weight):
+    """Every (role of the word, role of the co-argument, co-argument) group with its total weight, as in cypher"""
+    accepted_in = {"" if role == "None" else role for role in roles_in}
+    accepted_out = {"" if role == "None" else role for role in roles_out}
+    totals = collections.defaultdict(float)
+    for i, (event, word, role, _, _) in enumerate(edges):
+        if _WORDS[word] != (form, pos) or role not in accepted_in:
+            continue
+        for j, (event2, word2, role2, pmi, freq) in enumerate(edges):
+            if event2 == event and j != i and role2 in accepted_out and _WORDS[word2][0] not in gekutils.NAMED_ENTITIES:
+                totals[(role, role2) + _WORDS[word2]] += pmi if weight == "pmi" else pmi * freq
+    return sorted(((form2, pos2, score) for (_, _, form2, pos2), score in totals.items()), key=lambda x: -x[2])
+
+
+@pytest.mark.parametrize("weight", ["pmi", "lmi"])
+@pytest.mark.parametrize("roles_in,roles_out", [(["nsubj"], ["dobj", "None"]), (["nsubj", "amod"], ["dobj"]),
+                                                (["None"], ["nsubj", "amod", "dobj"])])
+def test_local_gek_ranks_as_brute_force(tmp_path, weight, roles_in, roles_out):
+    edges = _write_graph_csvs(tmp_path)
+    graph = gekutils.LocalGEK(str(tmp_path))
+
+    for form, pos in _WORDS:
+        expected = _brute_force_top_k(edges, form, pos, roles_in, roles_out, weight)
+
+        # ties are in no particular order, in cypher as well
+        everything = graph.top_k(form, pos, roles_in, roles_out, 100, weight)
+        assert sorted(everything) == sorted(expected)
+
+        top = graph.top_k(form, pos, roles_in, roles_out, 3, weight)
+        assert [score for _, _, score in top] == [score for _, _, score in expected[:3]]
+        assert all(item in expected for item in top)
+
+
+def test_gek_index_round_trip(tmp_path):
+    graph_dir, index_dir = tmp_path / "graph", tmp_path / "index"
+    graph_dir.mkdir()
+    index_dir.mkdir()
+    _write_graph_csvs(graph_dir)
+    (tmp_path / "relations").write_text("nsubj nsubj\ndobj dobj,None\n")
+
+    gekutils.write_gek_index(str(graph_dir), str(tmp_path / "relations"), str(index_dir), 5, ["pmi", "lmi"])
+    graph = gekutils.LocalGEK(str(graph_dir))
+    index = gekutils.GEKIndex(str(index_dir))
+
+    for form, pos in _WORDS:
+        for roles_in, roles_out in [(["nsubj"], ["dobj", "None"]), (["dobj", "None"], ["nsubj"])]:
+            for weight in ["pmi", "lmi"]:
+                expected = graph.top_k(form, pos, roles_in, roles_out, 4, weight)
+                assert index.top_k(form, pos, roles_in, roles_out, 4, weight) == expected
+
+    # any rewritten index file tells a cache file that it was filled from another index
+    source = index.source()
+    for fname in ["vocab.tsv", "offsets.npy", "scores.bin"]:
+        stat = os.stat(index_dir / fname)
+        os.utime(index_dir / fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert index.source() != source
+        source = index.source()
@@ -0,0 +1,41 @@
+import gzip
+
+from sdm.utils import graph_utils as gutils
+
+
+def _read_lines(fpath):
+    with open(fpath) as fin:
+        return fin.read().splitlines()
+
+
+def test_write_graph_nodes_and_edges(tmp_path):
+    stats_fpath = str(tmp_path / "lemma-freqs.gz")
+    with gzip.open(stats_fpath, "wt") as fout:
+        print("dog N\t3.0", file=fout)
+        print("bite V\t1.0", file=fout)
+    events_fpath = str(tmp_path / "events-freqs")
+    with open(events_fpath, "w") as fout:
+        print("dog@N@nsubj bite@V@HEAD\t2.0", file=fout)
+        print("dog@N@HEAD\t1.0", file=fout)
+        print("bite@V@HEAD\t3.0", file=fout)
+
+    gutils.write_graph(stats_fpath, events_fpath, str(tmp_path))
+
+    assert _read_lines(str(tmp_path / "words_nodes.csv")) == [
+        "wordId:ID(word-ID)\tform\tPOS\tfreq:int\tprob:float",
+        "1\tdog\tN\t3\t0.75",
+        "2\tbite\tV\t1\t0.25",
+    ]
+    assert _read_lines(str(tmp_path / "events_nodes.csv")) == [
+        "eventId:ID(event-ID)\tform\tfreq:int\tprob:float\tdeg:int",
+        "1\tdog@N@nsubj,bite@V@HEAD\t2\t1.0\t2",
+        "2\tdog@N@HEAD\t1\t0.25\t1",
+        "3\tbite@V@HEAD\t3\t0.75\t1",
+    ]
+    assert _read_lines(str(tmp_path / "event-word_edges.csv")) == [
+        ":START_ID(event-ID)\tfreq:int\tprob:float\tpmi:float\tdegree:int\trole\t:END_ID(word-ID)",
+        "1\t2\t0.0\t0.0\t2\tnsubj\t1",
+        "1\t2\t0.0\t0.0\t2\tHEAD\t2",
+        "2\t1\t0.0\t0.0\t1\tHEAD\t1",
+        "3\t3\t0.0\t0.0\t1\tHEAD\t2",
+    ]
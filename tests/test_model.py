@@ -0,0 +1,40 @@
+import types
+
+import numpy as np
+
+from sdm.core import model
+from sdm.utils import representation_utils as rutils
+from sdm.utils import trace_utils as tutils
+from sdm.utils import weight_utils as wutils
+
+
+def _sdm():
+    return types.SimpleNamespace(relations=["nsubj"], get_representation_function=rutils._centroid, M=2,
+                                 rank_forward=False, rank_backward=True, weight_function=wutils._batch_cosine,
+                                 trace=tutils.Trace(None, tutils.OFF))
+
+
+def _weighted_list(labels, vectors, weights):
+    return rutils.WeightedList.from_items(list(zip(labels, np.array(vectors, dtype=float), weights)))
+
+
+def _active_context(gek_vector):
+    ac = model.ActiveContext(_sdm())
+    ac.update({"nsubj": _weighted_list(["a", "b", "c"], [[1, 0], [0.9, 0.1], [0, 1]], [3., 2., 1.])})
+    ac.get_relation_vector("nsubj")
+    ac.update({"nsubj": _weighted_list(["d"], [gek_vector], [1.])})
+    return ac
+
+
+def test_rerank_keeping_top_m_is_not_dirty():
+    ac = _active_context([1, 0])
+
+    assert not ac.dirty["nsubj"]
+    assert [sublist.labels for sublist in ac.content["nsubj"]] == [["a", "b", "c"], ["d"]]
+
+
+def test_rerank_changing_top_m_is_dirty():
+    ac = _active_context([0, 1])
+
+    assert ac.dirty["nsubj"]
+    np.testing.assert_allclose(ac.get_relation_vector("nsubj"), [0.225, 0.775])
@@ -0,0 +1,15 @@
+import pytest
+
+from sdm.utils import vocabulary_utils as vutils
+
+
+def test_pack_fits_encodings():
+    packed = vutils.pack(vutils.MAX_LEMMAS - 1, vutils.REL_MASK)
+
+    assert len(vutils.encode_event((packed,))) == 9
+    assert len(vutils.encode_event_bytes((packed,))) == 5
+
+
+def test_pack_too_many_lemmas():
+    with pytest.raises(ValueError, match="lemmas"):
+        vutils.pack(vutils.MAX_LEMMAS, 0)